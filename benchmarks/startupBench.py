@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PACKAGE = Path(__file__).resolve().parent.parent
+# what the tray app may cost from launch until it sits idle in the tray, watching for devices
+DEFAULT_STARTUP_MS = 500
+DEFAULT_IDLE_MB = 40
+# modules the idle tray must not have loaded
+LAZY_MODULES = ("tkinter", "syncEngine", "transcoder", "ioTuning")
+RESULTS_VERSION = 1
+
+def resident() -> int:
+    # current resident set of this process in bytes
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize",
+                        "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                        "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+        counters = Counters(cb=ctypes.sizeof(Counters))
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+# runs in the child: starts the tray app the way main() does, minus the UI loop, waits for the
+# watcher's first device check and reports what was loaded by then
+def child(settle):
+    started = time.perf_counter()
+    sys.path.insert(0, str(PACKAGE))
+    import syncSysTray
+    imported = time.perf_counter()
+    app = syncSysTray.start()
+    while app.watcher.state is None:
+        time.sleep(0.001)
+    ready = time.perf_counter()
+    time.sleep(settle)
+    print(json.dumps({
+        "import_ms": round((imported - started) * 1000, 1),
+        "ready_ms": round((ready - started) * 1000, 1),
+        "idle_mb": round(resident() / 2**20, 1),
+        "loaded": [m for m in LAZY_MODULES if m in sys.modules],
+    }), flush=True)
+    os._exit(0)
+
+# one launch of a fresh interpreter against a throwaway config; startup_ms is from spawning
+# the process until it reports ready, so it includes interpreter startup
+def launch(workdir: Path, settle) -> dict:
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--child", "--settle", str(settle)],
+                            cwd=workdir, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    startup = time.perf_counter() - started - settle
+    proc.wait()
+    if not line:
+        raise RuntimeError(f"tray app exited with {proc.returncode} before reporting")
+    return {"startup_ms": round(startup * 1000, 1), **json.loads(line)}
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the tray app's startup time and idle memory against a budget.")
+    parser.add_argument("--runs", type=int, default=5, help="launches; the median is checked")
+    parser.add_argument("--max-startup-ms", type=float, default=DEFAULT_STARTUP_MS)
+    parser.add_argument("--max-idle-mb", type=float, default=DEFAULT_IDLE_MB)
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds idle before memory is measured")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child(args.settle)
+
+    with tempfile.TemporaryDirectory(prefix="musync-startup-") as tmp:
+        workdir = Path(tmp)
+        (workdir / "library").mkdir()
+        # no USB_DRIVE, so the device is looked up by a volume label that is never mounted
+        with open(workdir / "config.json", "w") as f:
+            json.dump({"LOCAL_FOLDER": str(workdir / "library"), "EXPECTED_VOLUME_NAME": "MUSYNC-BENCH",
+                       "REMOTE_FOLDER": "Music"}, f)
+        runs = [launch(workdir, args.settle) for _ in range(args.runs)]
+
+    startup = statistics.median(r["startup_ms"] for r in runs)
+    idle = statistics.median(r["idle_mb"] for r in runs)
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+    print(f"{'run':>4} {'startup ms':>11} {'import ms':>10} {'ready ms':>9} {'idle MB':>8}")
+    for i, r in enumerate(runs, 1):
+        print(f"{i:>4} {r['startup_ms']:>11.1f} {r['import_ms']:>10.1f} {r['ready_ms']:>9.1f} {r['idle_mb']:>8.1f}")
+    failures = []
+    if startup > args.max_startup_ms:
+        failures.append(f"startup {startup:.0f} ms is over the {args.max_startup_ms:.0f} ms budget")
+    if idle > args.max_idle_mb:
+        failures.append(f"idle memory {idle:.1f} MB is over the {args.max_idle_mb:.0f} MB budget")
+    if loaded:
+        failures.append("the idle tray loaded " + ", ".join(loaded))
+    print(f"median: startup {startup:.1f} ms, idle {idle:.1f} MB")
+    for failure in failures:
+        print("FAIL: " + failure)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"version": RESULTS_VERSION, "python": sys.version.split()[0], "platform": sys.platform,
+                       "budget": {"startup_ms": args.max_startup_ms, "idle_mb": args.max_idle_mb},
+                       "median": {"startup_ms": startup, "idle_mb": idle}, "runs": runs}, f, indent=2)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
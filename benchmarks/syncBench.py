@@ -0,0 +1,211 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from syncEngine import SyncEngine, LibrarySnapshot, MANIFEST_NAME, SNAPSHOT_FILE, DEFAULT_COPY_WORKERS
+
+# (min, max) file sizes in bytes, drawn log-uniformly
+SIZE_PROFILES = {
+    "tiny": (1024, 16 * 1024),
+    "small": (4 * 1024, 512 * 1024),
+    "music": (2 * 1024 * 1024, 12 * 1024 * 1024),
+}
+FILES_PER_DIR = 12
+SCENARIOS = ("cold", "warm", "noop")
+RESULTS_VERSION = 1
+
+def peak_rss() -> int:
+    # peak resident set of this process in bytes
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize",
+                        "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                        "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+        counters = Counters(cb=ctypes.sizeof(Counters))
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+# artist/album style tree: FILES_PER_DIR files per leaf folder, leaves spread evenly
+# over `depth` levels of folders
+def library_path(i, files, depth) -> str:
+    leaves = math.ceil(files / FILES_PER_DIR)
+    fanout = max(2, math.ceil(leaves ** (1 / depth)))
+    leaf = i // FILES_PER_DIR
+    parts = []
+    for _ in range(depth):
+        leaf, digit = divmod(leaf, fanout)
+        parts.append(f"d{digit:03d}")
+    return "/".join(reversed(parts)) + f"/track{i % FILES_PER_DIR:02d}.mp3"
+
+def generate_library(root: Path, files, sizes, depth, seed=0) -> int:
+    rng = random.Random(seed)
+    lo, hi = SIZE_PROFILES[sizes]
+    # one random block sliced at a different offset per file, so contents (and partial
+    # hashes) differ without paying for os.urandom on every file
+    block = os.urandom(hi + 4096)
+    total = 0
+    for i in range(files):
+        size = int(math.exp(rng.uniform(math.log(lo), math.log(hi))))
+        path = root / library_path(i, files, depth)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        offset = rng.randrange(4096)
+        with open(path, "wb") as f:
+            f.write(block[offset:offset + size])
+        total += size
+    return total
+
+# reuses a previously generated library when the parameters match
+def ensure_library(workdir: Path, files, sizes, depth, seed) -> tuple[Path, int]:
+    params = {"files": files, "sizes": sizes, "depth": depth, "seed": seed}
+    root = workdir / f"library-{files}-{sizes}-d{depth}-s{seed}"
+    stamp = root.with_suffix(".json")
+    try:
+        with open(stamp, "r") as f:
+            cached = json.load(f)
+        if cached["params"] == params:
+            return root, cached["bytes"]
+    except (OSError, ValueError, KeyError):
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+    print(f"Generating {files} files ({sizes}, depth {depth}) in {root}", file=sys.stderr)
+    total = generate_library(root, files, sizes, depth, seed)
+    workdir.mkdir(parents=True, exist_ok=True)
+    with open(stamp, "w") as f:
+        json.dump({"params": params, "bytes": total}, f)
+    return root, total
+
+# one scenario in a fresh process, so peak memory belongs to that scenario alone
+def measure(source, dest, state_dir, workers) -> dict:
+    started = time.perf_counter()
+    snapshot = LibrarySnapshot(source, os.path.join(state_dir, SNAPSHOT_FILE))
+    scanned = sum(1 for _ in snapshot.scan())
+    scan_seconds = time.perf_counter() - started
+
+    engine = SyncEngine(source, dest, copy_workers=workers, state_dir=state_dir)
+    started = time.perf_counter()
+    plan = engine.plan()
+    plan_seconds = time.perf_counter() - started
+
+    engine = SyncEngine(source, dest, copy_workers=workers, state_dir=state_dir)
+    engine.run()
+    counts = engine.counts
+    processed = sum(counts.values()) - counts["delete"]
+    seconds = max(engine.seconds, 1e-9)
+    return {
+        "scanned": scanned,
+        "planned_changes": sum(1 for step in plan if step["action"] != "skip"),
+        "scan_seconds": round(scan_seconds, 4),
+        "plan_seconds": round(plan_seconds, 4),
+        "sync_seconds": round(engine.seconds, 4),
+        "counts": counts,
+        "bytes_copied": engine.bytes_copied,
+        "files_per_second": round(processed / seconds, 1),
+        "mb_per_second": round(engine.bytes_copied / seconds / 2**20, 2),
+        "mkdirs": engine.io.get("mkdir", [0])[0],
+        "peak_rss_mb": round(peak_rss() / 2**20, 1),
+        "error": engine.error,
+    }
+
+def run_scenario(name, source, dest: Path, state_dir: Path, workers) -> dict:
+    if name == "cold":
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.rmtree(state_dir, ignore_errors=True)
+    elif name == "warm":
+        # device already holds the library, but every cache is dropped and both sides are rescanned
+        shutil.rmtree(state_dir, ignore_errors=True)
+        try: os.remove(dest / MANIFEST_NAME)
+        except OSError: pass
+    state_dir.mkdir(parents=True, exist_ok=True)
+    out = subprocess.run([sys.executable, __file__, "--child", str(source), str(dest), str(state_dir), str(workers)],
+                         capture_output=True, text=True, check=True)
+    return {"scenario": name, **json.loads(out.stdout)}
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent,
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# prints the change of each timing and memory figure against an earlier results file
+def compare(old, new):
+    before = {(r["files"], r["sizes"], r["depth"], r["scenario"]): r for r in old["results"]}
+    for r in new["results"]:
+        prev = before.get((r["files"], r["sizes"], r["depth"], r["scenario"]))
+        if not prev: continue
+        changes = []
+        for key in ("scan_seconds", "plan_seconds", "sync_seconds", "peak_rss_mb"):
+            if prev[key]:
+                changes.append(f"{key} {(r[key] - prev[key]) / prev[key] * 100:+.0f}%")
+        print(f"{r['files']:>7} {r['sizes']:<6} {r['scenario']:<5} " + ", ".join(changes))
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "--child":
+        source, dest, state_dir, workers = argv[1:5]
+        print(json.dumps(measure(source, dest, state_dir, int(workers))))
+        return 0
+
+    parser = argparse.ArgumentParser(description="Benchmark syncEngine against synthetic music libraries.")
+    parser.add_argument("--files", default="1000", help="comma separated library sizes, e.g. 1000,10000,200000")
+    parser.add_argument("--sizes", choices=SIZE_PROFILES, default="small", help="file size distribution")
+    parser.add_argument("--depth", type=int, default=2, help="folder levels above each album folder")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=DEFAULT_COPY_WORKERS)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--workdir", help="where libraries and the stand-in device live (default: a temp folder, kept between runs)")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    workdir = Path(args.workdir or os.path.join(tempfile.gettempdir(), "musync-bench"))
+    scenarios = [s for s in args.scenarios.split(",") if s in SCENARIOS]
+    results = []
+    for files in (int(n) for n in args.files.split(",")):
+        source, total = ensure_library(workdir, files, args.sizes, args.depth, args.seed)
+        dest, state_dir = workdir / "device", workdir / "state"
+        if scenarios[0] != "cold":
+            run_scenario("cold", source, dest, state_dir, args.workers)
+        for name in scenarios:
+            r = {"files": files, "sizes": args.sizes, "depth": args.depth, "library_bytes": total,
+                 **run_scenario(name, source, dest, state_dir, args.workers)}
+            results.append(r)
+            print(f"{files:>7} {args.sizes:<6} {name:<5} scan {r['scan_seconds']:8.3f}s  plan {r['plan_seconds']:8.3f}s  "
+                  f"sync {r['sync_seconds']:8.3f}s  {r['files_per_second']:9.1f} files/s  {r['mb_per_second']:8.2f} MB/s  "
+                  f"peak {r['peak_rss_mb']:7.1f} MB", file=sys.stderr)
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    report = {"version": RESULTS_VERSION, "revision": git_revision(), "python": platform.python_version(),
+              "platform": platform.platform(), "workers": args.workers, "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
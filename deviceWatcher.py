@@ -0,0 +1,194 @@
+import ctypes
+import os
+import select
+import sys
+import threading
+from pathlib import Path
+
+POLL_MIN_SECONDS = 1
+POLL_MAX_SECONDS = 8
+BACKENDS = ("auto", "events", "mountinfo", "poll")
+
+MOUNTINFO = "/proc/self/mountinfo"
+BY_LABEL = "/dev/disk/by-label"
+# WM_DEVICECHANGE wparam values for a volume being mounted or removed
+DBT_DEVICEARRIVAL = 0x8000
+DBT_DEVICEREMOVECOMPLETE = 0x8004
+
+def mount_source(path: Path) -> str | None:
+    # device of the longest mount point containing path, from the mount table
+    best, source = "", None
+    target = os.path.realpath(path)
+    try:
+        with open(MOUNTINFO, "r") as f:
+            for line in f:
+                fields = line.split()
+                point = fields[4].replace("\\040", " ")
+                sep = fields.index("-")
+                if (target == point or target.startswith(point.rstrip("/") + "/")) and len(point) > len(best):
+                    best, source = point, fields[sep + 2]
+    except (OSError, ValueError, IndexError):
+        return None
+    return source
+
+def get_volume_label(drive: Path) -> str | None:
+    if sys.platform == "win32":
+        try:
+            buf = ctypes.create_unicode_buffer(1024)
+            success = ctypes.windll.kernel32.GetVolumeInformationW(
+                ctypes.c_wchar_p(str(drive)),
+                buf,
+                ctypes.sizeof(buf),
+                None,
+                None,
+                None,
+                None,
+                0,
+            )
+            return buf.value if success else None
+        except Exception:
+            return None
+    # elsewhere the label comes from udev's by-label links to the mounted device
+    source = mount_source(drive)
+    if source is None:
+        return None
+    try:
+        for name in os.listdir(BY_LABEL):
+            if os.path.realpath(os.path.join(BY_LABEL, name)) == os.path.realpath(source):
+                return name.encode().decode("unicode_escape")
+    except OSError:
+        pass
+    return None
+
+# {volume label: mount root} of the mounted volumes, the first one wins for duplicate labels
+def mounted_volumes() -> dict[str, Path]:
+    volumes = {}
+    if sys.platform == "win32":
+        mask = ctypes.windll.kernel32.GetLogicalDrives()
+        # A: and B: are skipped, probing an empty floppy drive is slow
+        for i in range(2, 26):
+            if mask >> i & 1:
+                root = Path(f"{chr(65 + i)}:/")
+                label = get_volume_label(root)
+                if label: volumes.setdefault(label, root)
+        return volumes
+    try:
+        labels = {os.path.realpath(os.path.join(BY_LABEL, name)): name.encode().decode("unicode_escape")
+                  for name in os.listdir(BY_LABEL)}
+        with open(MOUNTINFO, "r") as f:
+            for line in f:
+                fields = line.split()
+                source = fields[fields.index("-") + 2]
+                if source.startswith("/dev/") and os.path.realpath(source) in labels:
+                    volumes.setdefault(labels[os.path.realpath(source)], Path(fields[4].replace("\\040", " ")))
+    except (OSError, ValueError, IndexError):
+        pass
+    return volumes
+
+# Watches for a device by calling check() whenever something may have changed and reports
+# on_change(state) only when the result differs from the last one. The base class polls,
+# backing off from POLL_MIN_SECONDS to POLL_MAX_SECONDS while nothing changes; subclasses
+# wait on OS notifications instead and fall back to polling when those are unavailable.
+class DeviceWatcher:
+    name = "poll"
+
+    def __init__(self, check, on_change):
+        self.check = check
+        self.on_change = on_change
+        self.state = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    # may also be called from other threads, e.g. after the settings change
+    def refresh(self) -> bool:
+        with self.lock:
+            state = self.check()
+            if state == self.state:
+                return False
+            self.state = state
+        self.on_change(state)
+        return True
+
+    def run(self):
+        self.poll()
+
+    def poll(self):
+        interval = POLL_MIN_SECONDS
+        while not self.stopped.is_set():
+            interval = POLL_MIN_SECONDS if self.refresh() else min(interval * 2, POLL_MAX_SECONDS)
+            self.stopped.wait(interval)
+
+    def stop(self):
+        self.stopped.set()
+
+# Linux: the kernel flags /proc/self/mountinfo with POLLPRI whenever the mount table changes,
+# so the thread sleeps in poll() until something is mounted or unmounted
+class MountinfoWatcher(DeviceWatcher):
+    name = "mountinfo"
+
+    def run(self):
+        try:
+            f = open(MOUNTINFO, "r")
+        except OSError:
+            return self.poll()
+        self.wake_r, self.wake_w = os.pipe()
+        poller = select.poll()
+        poller.register(f, select.POLLPRI | select.POLLERR)
+        poller.register(self.wake_r, select.POLLIN)
+        with f:
+            while not self.stopped.is_set():
+                # reading the table re-arms the notification
+                f.seek(0)
+                f.read()
+                self.refresh()
+                poller.poll()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def stop(self):
+        super().stop()
+        try: os.write(self.wake_w, b"x")
+        except (AttributeError, OSError): pass
+
+# Windows: a hidden top-level window receives the WM_DEVICECHANGE broadcasts sent when a
+# volume arrives or is removed; message-only windows don't get broadcasts
+class WindowsDeviceEvents(DeviceWatcher):
+    name = "events"
+    hwnd = None
+
+    def run(self):
+        try:
+            import win32api, win32con, win32gui
+            wc = win32gui.WNDCLASS()
+            wc.lpszClassName = "muSyncDeviceWatcher"
+            wc.hInstance = win32api.GetModuleHandle(None)
+            wc.lpfnWndProc = {win32con.WM_DEVICECHANGE: self.on_device_change, win32con.WM_CLOSE: self.on_close}
+            self.hwnd = win32gui.CreateWindow(win32gui.RegisterClass(wc), "muSync", 0, 0, 0, 0, 0, 0, 0, wc.hInstance, None)
+        except Exception:
+            return self.poll()
+        self.refresh()
+        if not self.stopped.is_set():
+            win32gui.PumpMessages()
+
+    def on_device_change(self, hwnd, msg, wparam, lparam):
+        if wparam in (DBT_DEVICEARRIVAL, DBT_DEVICEREMOVECOMPLETE):
+            self.refresh()
+        return True
+
+    def on_close(self, hwnd, msg, wparam, lparam):
+        import win32gui
+        win32gui.DestroyWindow(hwnd)
+        win32gui.PostQuitMessage(0)
+        return 0
+
+    def stop(self):
+        super().stop()
+        if self.hwnd:
+            import win32con, win32gui
+            win32gui.PostMessage(self.hwnd, win32con.WM_CLOSE, 0, 0)
+
+def make_watcher(check, on_change, backend="auto") -> DeviceWatcher:
+    if backend == "auto":
+        backend = "events" if sys.platform == "win32" else "mountinfo" if os.path.exists(MOUNTINFO) else "poll"
+    cls = {"events": WindowsDeviceEvents, "mountinfo": MountinfoWatcher}.get(backend, DeviceWatcher)
+    return cls(check, on_change)
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# the calibration writes CALIBRATE_BYTES once per buffer size and once more to read back, then
+# CALIBRATE_SMALL_FILES files per worker count and once more unsynced; about 42 MB in all, though
+# at most 10 MB is on the device at a time. Its files start with .musync so scans skip them.
+CALIBRATE_PREFIX = ".musync-calibrate"
+CALIBRATE_BYTES = 8 * 2**20
+CALIBRATE_BUFFERS = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+CALIBRATE_WORKERS = (1, 2, 4, 8)
+CALIBRATE_SMALL_FILES = 16
+CALIBRATE_SMALL_BYTES = 128 * 1024
+# a smaller buffer or fewer workers win when within this share of the best result
+CALIBRATE_TOLERANCE = 0.05
+# per-file fsync has to cost this many times the unsynced write before it is batched
+FSYNC_BATCH_RATIO = 2.0
+MAX_WORKERS = 8
+
+# the concurrency tuner re-measures every TUNE_INTERVAL seconds and only reacts to changes
+# in MB/s larger than TUNE_TOLERANCE
+TUNE_INTERVAL = 3.0
+TUNE_TOLERANCE = 0.1
+
+# writes total bytes of data in buffer-sized writes; returns the digest of what was written
+def write_test_file(path, data: memoryview, total, buffer, sync=True) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "wb") as f:
+        written = 0
+        while written < total:
+            chunk = data[:min(buffer, total - written)]
+            f.write(chunk)
+            h.update(chunk)
+            written += len(chunk)
+        f.flush()
+        if sync: os.fsync(f.fileno())
+    return h.digest()
+
+def timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    return max(time.perf_counter() - started, 1e-6)
+
+# the first candidate whose score is within CALIBRATE_TOLERANCE of the best; candidates are
+# ordered cheapest first
+def cheapest(scores: dict):
+    best = max(scores.values())
+    return next(c for c, score in scores.items() if score >= best * (1 - CALIBRATE_TOLERANCE))
+
+# Measures a device folder with a few test writes and returns its I/O profile:
+#   {"buffer_kb", "workers", "fsync": "file" | "batch", "write_mb_s", "read_mb_s", "read_ok", "calibrated_at"}
+# "batch" means syncing the whole volume once per journal batch instead of each file, and is
+# only picked where os.sync exists. Returns None when cancelled or short of space.
+def calibrate(folder: Path, cancelled=None) -> dict | None:
+    try:
+        from shutil import disk_usage
+        if disk_usage(folder).free < 4 * CALIBRATE_BYTES:
+            return None
+    except OSError:
+        return None
+    data = memoryview(os.urandom(max(CALIBRATE_BUFFERS)))
+    big = folder / (CALIBRATE_PREFIX + ".tmp")
+    small = [folder / f"{CALIBRATE_PREFIX}-{i}.tmp" for i in range(CALIBRATE_SMALL_FILES)]
+    try:
+        # buffer size: MB/s of one large sequential write per candidate
+        rates = {}
+        for buffer in CALIBRATE_BUFFERS:
+            if cancelled and cancelled(): return None
+            rates[buffer] = CALIBRATE_BYTES / timed(write_test_file, big, data, CALIBRATE_BYTES, buffer)
+        buffer = cheapest(rates)
+
+        # read back a fresh write, uncached where the OS allows, to check the device returns what it was given
+        expected = write_test_file(big, data, CALIBRATE_BYTES, buffer)
+        actual = hashlib.blake2b(digest_size=16)
+        def read_back():
+            with open(big, "rb") as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                while chunk := f.read(buffer):
+                    actual.update(chunk)
+        read_seconds = timed(read_back)
+
+        # workers: files/s writing small files in parallel, each synced like a real copy
+        def write_small(workers, sync=True):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda p: write_test_file(p, data, CALIBRATE_SMALL_BYTES, buffer, sync), small))
+        files_per_second = {}
+        for workers in CALIBRATE_WORKERS:
+            if cancelled and cancelled(): return None
+            files_per_second[workers] = CALIBRATE_SMALL_FILES / timed(write_small, workers)
+        workers = cheapest(files_per_second)
+
+        # fsync policy: how much the per-file sync costs on top of the writes themselves
+        unsynced = timed(write_small, workers, False)
+        synced = CALIBRATE_SMALL_FILES / files_per_second[workers]
+        fsync = "batch" if hasattr(os, "sync") and synced > unsynced * FSYNC_BATCH_RATIO else "file"
+        return {
+            "buffer_kb": buffer // 1024,
+            "workers": workers,
+            "fsync": fsync,
+            "write_mb_s": round(rates[buffer] / 2**20, 1),
+            "read_mb_s": round(CALIBRATE_BYTES / read_seconds / 2**20, 1),
+            "read_ok": actual.digest() == expected,
+            "calibrated_at": int(time.time()),
+        }
+    except OSError:
+        return None
+    finally:
+        for path in [big, *small]:
+            try: os.remove(path)
+            except OSError: pass
+
+# Hill-climbs the number of concurrent copies on measured throughput: every TUNE_INTERVAL
+# seconds it compares MB/s with the last interval, keeps stepping the same way while that
+# improves and turns around when it drops or when adding a worker gained nothing. It holds
+# once the step back has paid off, i.e. at the peak, and while MB/s stays level.
+class ConcurrencyTuner:
+    def __init__(self, workers, max_workers=MAX_WORKERS):
+        self.workers = workers
+        self.max_workers = max_workers
+        self.step = 1
+        self.turned = False
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.last_rate = None
+
+    # called from the copy workers
+    def add(self, n):
+        with self.lock:
+            self.bytes += n
+
+    # called from the sync thread; returns how many copies should run now
+    def update(self) -> int:
+        now = time.monotonic()
+        if now - self.started < TUNE_INTERVAL:
+            return self.workers
+        with self.lock:
+            rate = self.bytes / (now - self.started)
+            self.bytes = 0
+        self.started = now
+        last, self.last_rate = self.last_rate, rate
+        if last is not None:
+            level = rate <= last * (1 + TUNE_TOLERANCE)
+            if rate < last * (1 - TUNE_TOLERANCE) or (level and self.step > 0 and not self.turned):
+                self.step = -self.step
+                self.turned = True
+            elif self.turned or level:
+                self.turned = False
+                return self.workers
+        self.workers = min(self.max_workers, max(1, self.workers + self.step))
+        return self.workers
+
+# caps the combined write rate of all copy workers at mb_per_second
+class Throttle:
+    def __init__(self, mb_per_second):
+        self.rate = mb_per_second * 2**20
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    # called from the copy workers after each chunk
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + n / self.rate
+            # the bytes are already written; wait until the cap would have allowed them
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
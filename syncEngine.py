@@ -0,0 +1,1720 @@
+import argparse
+import contextlib
+import fnmatch
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from pathlib import Path
+
+from ioTuning import calibrate, ConcurrencyTuner, Throttle, MAX_WORKERS
+from transcoder import TranscodeCache, Transcoder, CODECS, TRANSCODE_DIR, DEFAULT_CACHE_MB
+
+HASH_CACHE_FILE = "hash_cache.json"
+SNAPSHOT_FILE = "library_snapshot.json"
+SNAPSHOT_VERSION = 1
+# per-sync timing reports and the optional profile of the sync thread, kept next to the config
+REPORT_DIR = "sync_reports"
+REPORT_KEEP = 20
+PROFILE_FILE = "sync_profile.prof"
+SLOWEST_FILES = 10
+REPORT_ERRORS = 50
+# the progress window shows the last LOG_VIEW_LINES lines, refreshed at most every PROGRESS_INTERVAL seconds
+LOG_FILE = "sync_log.txt"
+LOG_VIEW_LINES = 500
+PROGRESS_INTERVAL = 0.1
+
+# on-device manifest of synced files, kept in the remote folder
+MANIFEST_NAME = ".musync_manifest.json"
+MANIFEST_VERSION = 1
+MANIFEST_SAMPLE_SIZE = 16
+# FAT stores mtimes with 2 second resolution
+MTIME_TOLERANCE = 2
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+# smaller files fit in a cluster or two, reserving their space up front gains nothing
+PREALLOCATE_MIN_BYTES = 1024 * 1024
+# fallocate(2) mode that reserves space without changing the file size (the only mode vfat has)
+FALLOC_FL_KEEP_SIZE = 1
+PARTIAL_HASH_BYTES = 64 * 1024
+
+# checksums taken while copying, kept on the device next to the manifest; an incremental
+# verify only re-reads files last verified more than VERIFY_HOURS ago
+CHECKSUMS_NAME = ".musync_checksums.json"
+CHECKSUMS_VERSION = 1
+DEFAULT_VERIFY_HOURS = 30 * 24
+
+# write-ahead journal of the current plan, so an interrupted sync resumes without rescanning
+JOURNAL_NAME = ".musync_journal.jsonl"
+# exists on the device while partial files may be left behind by an interrupted copy
+PARTIALS_MARKER = ".musync_partials"
+JOURNAL_VERSION = 1
+JOURNAL_BATCH = 64
+JOURNAL_FLUSH_SECONDS = 2
+
+# space kept free on the device; covers the temp files of in-flight updates and directory entries
+DEFAULT_SPACE_RESERVE_MB = 64
+# assumed allocation unit when the filesystem doesn't report one (FAT32 on large sticks)
+DEFAULT_CLUSTER_SIZE = 32 * 1024
+
+DEFAULT_COPY_WORKERS = 4
+DEFAULT_FULL_RESCAN_HOURS = 24
+DEFAULT_DELETE_CAP = 50
+
+def is_internal_file(name: str) -> bool:
+    return name.startswith(".musync")
+
+def format_bytes(n) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def hash_file(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+# cheap fingerprint for move detection: the size plus the first and last 64 KB
+def partial_hash(path: Path, size) -> str:
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as f:
+        h.update(f.read(PARTIAL_HASH_BYTES))
+        if size > PARTIAL_HASH_BYTES:
+            f.seek(max(PARTIAL_HASH_BYTES, size - PARTIAL_HASH_BYTES))
+            h.update(f.read(PARTIAL_HASH_BYTES))
+    return h.hexdigest()
+
+# full and partial content hashes of local files, reused while size and mtime are unchanged.
+# Entries are [size, mtime, full hash, partial hash], either hash may be None.
+class HashCache:
+    def __init__(self, path=HASH_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, rel: str, size, mtime) -> list:
+        cached = self.entries.get(rel)
+        if cached and cached[0] == size and cached[1] == mtime:
+            cached.extend([None] * (4 - len(cached)))
+            return cached
+        entry = self.entries[rel] = [size, mtime, None, None]
+        return entry
+
+    def get(self, base_dir: Path, rel: str, size, mtime) -> str:
+        entry = self.lookup(rel, size, mtime)
+        if entry[2] is None:
+            entry[2] = hash_file(base_dir / rel)
+            self.dirty = True
+        return entry[2]
+
+    def partial(self, base_dir: Path, rel: str, size, mtime) -> str:
+        entry = self.lookup(rel, size, mtime)
+        if entry[3] is None:
+            entry[3] = partial_hash(base_dir / rel, size)
+            self.dirty = True
+        return entry[3]
+
+    # a full hash taken elsewhere, e.g. from the stream while copying the file
+    def remember(self, rel: str, size, mtime, digest):
+        entry = self.lookup(rel, size, mtime)
+        if entry[2] != digest:
+            entry[2] = digest
+            self.dirty = True
+
+    # may be shared by concurrent syncs, so saves are serialized and work on a copy
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(dict(self.entries), f, separators=(",", ":"))
+                os.replace(tmp, self.path)
+            except OSError:
+                self.dirty = True
+
+def iter_files(base_dir: Path):
+    # yields (rel, size, mtime) as directories are listed; DirEntry.stat() is served
+    # from the directory listing on Windows, so this is one round-trip per folder
+    stack = [(str(base_dir), "")]
+    while stack:
+        path, prefix = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            rel = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, rel + "/"))
+            elif entry.is_file() and not is_internal_file(entry.name):
+                st = entry.stat()
+                yield rel, st.st_size, st.st_mtime
+
+def scan_files(base_dir: Path) -> dict[str, list]:
+    return {rel: [size, mtime] for rel, size, mtime in iter_files(base_dir)}
+
+# runs a (rel, size, mtime) scan on a background thread so consumers can start before the
+# walk finishes; yields the same tuples, bounded so a fast scan can't run far ahead. An
+# exception in the scan is raised in the consumer rather than ending the stream early.
+def stream_files(items, maxsize=4096):
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    failure = []
+    def scan():
+        try:
+            for item in items:
+                if stop.is_set(): return
+                q.put(item)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            q.put(None)
+    threading.Thread(target=scan, daemon=True).start()
+    try:
+        while (item := q.get()) is not None:
+            yield item
+        if failure:
+            raise failure[0]
+    finally:
+        stop.set()
+        # unblock the scanner if it is waiting on a full queue
+        while not q.empty():
+            try: q.get_nowait()
+            except queue.Empty: break
+
+# persisted listing of the local library: {rel_dir: [dir mtime, [subdir names], {name: [size, mtime]}]}.
+# A rescan only lists directories whose mtime changed; the rest keep their cached names and
+# just have those files stat'ed, which also catches tracks retagged in place. Folder mtimes
+# aren't reliable on every filesystem, so the cache is ignored for a full listing every
+# full_rescan_hours. Paths that could not be read, "" for the root, end up in unreadable;
+# the listing is incomplete then and must not drive deletions.
+class LibrarySnapshot:
+    def __init__(self, base_dir: Path, path=SNAPSHOT_FILE, full_rescan_hours=DEFAULT_FULL_RESCAN_HOURS):
+        self.base_dir = str(base_dir)
+        self.path = path
+        self.full_rescan_hours = full_rescan_hours
+        self.dirs = {}
+        self.scanned_at = 0
+        self.added, self.modified, self.removed = [], [], []
+        self.rescanned = 0
+        self.unreadable = []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == SNAPSHOT_VERSION and data.get("root") == self.base_dir:
+                self.dirs = data["dirs"]
+                self.scanned_at = data.get("scanned_at", 0)
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    # yields (rel, size, mtime) for every local file; the added/modified/removed diff is for the log,
+    # the planner compares every file with the device manifest itself
+    def scan(self):
+        old = self.dirs
+        reuse = time.time() - self.scanned_at < self.full_rescan_hours * 3600
+        new = {}
+        added, modified, removed = [], [], []
+        unreadable = self.unreadable = []
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            path = os.path.join(self.base_dir, rel_dir)
+            try:
+                dir_mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                # a subfolder deleted since its parent was listed is simply gone
+                if not rel_dir: unreadable.append(rel_dir)
+                continue
+            except OSError:
+                unreadable.append(rel_dir)
+                continue
+            prefix = rel_dir + "/" if rel_dir else ""
+            cached = old.get(rel_dir)
+            if reuse and cached and cached[0] == dir_mtime:
+                # same names as last time, but a file rewritten in place only shows in its own stat
+                subdirs, files = cached[1], {}
+                for name, stat in cached[2].items():
+                    try:
+                        st = os.stat(os.path.join(path, name))
+                    except FileNotFoundError:
+                        removed.append(prefix + name)
+                        continue
+                    except OSError:
+                        unreadable.append(prefix + name)
+                        continue
+                    files[name] = [st.st_size, st.st_mtime]
+                    if files[name] != stat: modified.append(prefix + name)
+            else:
+                try:
+                    entries = list(os.scandir(path))
+                except OSError:
+                    unreadable.append(rel_dir)
+                    continue
+                self.rescanned += 1
+                subdirs, files = [], {}
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file() and not is_internal_file(entry.name):
+                            st = entry.stat()
+                            files[entry.name] = [st.st_size, st.st_mtime]
+                    except OSError:
+                        unreadable.append(prefix + entry.name)
+                old_files = cached[2] if cached else {}
+                for name, stat in files.items():
+                    if name not in old_files: added.append(prefix + name)
+                    elif old_files[name] != stat: modified.append(prefix + name)
+                removed.extend(prefix + name for name in old_files if name not in files)
+            new[rel_dir] = [dir_mtime, subdirs, files]
+            for name, (size, mtime) in files.items():
+                yield prefix + name, size, mtime
+            stack.extend(prefix + d for d in subdirs)
+        for rel_dir, (_, _, files) in old.items():
+            if rel_dir not in new:
+                prefix = rel_dir + "/" if rel_dir else ""
+                removed.extend(prefix + name for name in files)
+        self.dirs = new
+        self.scanned_at = time.time() if not reuse else self.scanned_at
+        self.added, self.modified, self.removed = added, modified, removed
+
+    def files(self) -> dict[str, list]:
+        return {(rel_dir + "/" if rel_dir else "") + name: stat
+                for rel_dir, (_, _, files) in self.dirs.items() for name, stat in files.items()}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": SNAPSHOT_VERSION, "root": self.base_dir, "scanned_at": self.scanned_at,
+                           "dirs": self.dirs}, f, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+# one scan of the local library and one hash cache shared by syncs to several devices. The
+# scan is teed: every sync streams it from the start, and whichever one is furthest ahead
+# advances the walk, so the first sync copies while scanning as it would on its own.
+class SharedLibrary:
+    def __init__(self, base_dir: Path, state_dir=".", full_rescan_hours=DEFAULT_FULL_RESCAN_HOURS):
+        self.state_dir = state_dir
+        self.snapshot = LibrarySnapshot(base_dir, os.path.join(state_dir, SNAPSHOT_FILE), full_rescan_hours)
+        self.hashes = HashCache(os.path.join(state_dir, HASH_CACHE_FILE))
+        self.lock = threading.Lock()
+        self.walk = None
+        self.entries = []
+        self.scanned = None
+        self.transcodes = None
+
+    # yields (rel, size, mtime) like LibrarySnapshot.scan, from one walk shared by all callers
+    def scan(self):
+        i = 0
+        while True:
+            with self.lock:
+                if i < len(self.entries):
+                    item = self.entries[i]
+                elif self.scanned is not None:
+                    return
+                else:
+                    if self.walk is None: self.walk = self.snapshot.scan()
+                    item = next(self.walk, None)
+                    if item is None:
+                        self.snapshot.save()
+                        self.scanned = self.snapshot.files()
+                        return
+                    self.entries.append(item)
+            i += 1
+            yield item
+
+    def files(self) -> dict[str, list]:
+        for _ in self.scan(): pass
+        return self.scanned
+
+    # one encode cache and encoder pool for every device; the first sync's settings size it
+    def transcode_cache(self, settings) -> TranscodeCache:
+        with self.lock:
+            if self.transcodes is None:
+                self.transcodes = TranscodeCache(os.path.join(self.state_dir, TRANSCODE_DIR), settings["cache_mb"] * 2**20,
+                                                 settings["workers"], settings["ffmpeg"])
+        return self.transcodes
+
+    def close(self):
+        if self.transcodes:
+            self.transcodes.close()
+
+# include/exclude are fnmatch patterns on the library-relative path; no include means everything
+def matches_filters(rel, include=(), exclude=()) -> bool:
+    if include and not any(fnmatch.fnmatch(rel, pattern) for pattern in include):
+        return False
+    return not any(fnmatch.fnmatch(rel, pattern) for pattern in exclude)
+
+# manifest entries are [size, mtime, full hash, partial hash, source] with trailing unknowns
+# dropped; source is "<encoder settings>:<source size>" for transcoded files
+def manifest_entry(size, mtime, digest=None, partial=None, source=None) -> list:
+    entry = [size, mtime, digest, partial, source]
+    while len(entry) > 2 and entry[-1] is None:
+        entry.pop()
+    return entry
+
+def manifest_entry_matches(base_dir: Path, rel: str, entry) -> bool:
+    try:
+        st = os.stat(base_dir / rel)
+    except OSError:
+        return False
+    return st.st_size == entry[0] and abs(st.st_mtime - entry[1]) <= MTIME_TOLERANCE
+
+def load_device_manifest(base_dir: Path) -> dict[str, list] | None:
+    try:
+        with open(base_dir / MANIFEST_NAME, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        return None
+    files = data.get("files")
+    if not isinstance(files, dict):
+        return None
+    # cheap staleness check: stat a random sample instead of walking the device
+    sample = random.sample(list(files.items()), min(MANIFEST_SAMPLE_SIZE, len(files)))
+    if not all(manifest_entry_matches(base_dir, rel, entry) for rel, entry in sample):
+        return None
+    return files
+
+def save_device_manifest(base_dir: Path, files: dict[str, list]) -> bool:
+    target = base_dir / MANIFEST_NAME
+    tmp = target.with_name(MANIFEST_NAME + ".tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": files}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+        return True
+    except OSError:
+        return False
+
+def load_device_files(base_dir: Path) -> dict[str, list]:
+    files = load_device_manifest(base_dir)
+    if files is None:
+        files = scan_files(base_dir)
+    return files
+
+# on-device record of the checksum each file had when it was copied and when it was last
+# read back intact: {rel: [digest, verified at]}. Unlike the manifest it is never rebuilt
+# from a scan, so it survives the manifest being dropped as stale.
+class DeviceChecksums:
+    def __init__(self, base_dir: Path):
+        self.path = base_dir / CHECKSUMS_NAME
+        self.files = {}
+        self.dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CHECKSUMS_VERSION and isinstance(data.get("files"), dict):
+                self.files = data["files"]
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, rel, digest):
+        self.files[rel] = [digest, 0]
+        self.dirty = True
+
+    def move(self, old, new):
+        if old in self.files:
+            self.files[new] = self.files.pop(old)
+            self.dirty = True
+
+    def verified(self, rel, when):
+        self.files[rel][1] = when
+        self.dirty = True
+
+    def forget(self, rel):
+        if self.files.pop(rel, None) is not None:
+            self.dirty = True
+
+    # keep: the device files; checksums of anything else are dropped
+    def save(self, keep=None) -> bool:
+        if keep is not None and any(rel not in keep for rel in self.files):
+            self.files = {rel: entry for rel, entry in self.files.items() if rel in keep}
+            self.dirty = True
+        if not self.dirty:
+            return True
+        tmp = self.path.with_name(CHECKSUMS_NAME + ".tmp")
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": CHECKSUMS_VERSION, "files": self.files}, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            return False
+        self.dirty = False
+        return True
+
+# append-only log of planned transfers and completed ones, flushed in batches to keep
+# small writes to the device down. Skips are never journaled.
+class SyncJournal:
+    # sync_data flushes the whole volume before each batch, for copies that weren't fsynced one by one
+    def __init__(self, base_dir: Path, local_dir: Path, resume=False, sync_data=False):
+        self.path = base_dir / JOURNAL_NAME
+        self.sync_data = sync_data
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        try:
+            self.file = open(self.path, "a" if resume else "w", encoding="utf-8")
+        except OSError:
+            self.file = None
+        if not resume:
+            self.write({"journal": JOURNAL_VERSION, "local": str(local_dir)})
+
+    def planned(self, action, rel, size, mtime):
+        self.write({"plan": [action, rel, size, mtime]})
+
+    def completed(self, rel):
+        self.write({"done": rel})
+
+    def plan_complete(self, total):
+        self.write({"end": total})
+        self.flush()
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record, separators=(",", ":")))
+        if len(self.buffer) >= JOURNAL_BATCH or time.monotonic() - self.last_flush >= JOURNAL_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer or self.file is None:
+            return
+        try:
+            if self.sync_data: os.sync()
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            # device went away; the manifest still records what was finished
+            self.file = None
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            try: self.file.close()
+            except OSError: pass
+            self.file = None
+
+    def discard(self):
+        self.buffer.clear()
+        self.close()
+        try: os.remove(self.path)
+        except OSError: pass
+
+# returns the unfinished (action, rel, size, mtime) entries of a fully planned sync of
+# local_dir, or None when there is nothing to resume
+def load_journal(base_dir: Path, local_dir: Path):
+    try:
+        with open(base_dir / JOURNAL_NAME, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    plan, done, complete = {}, set(), False
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break  # torn final batch
+        if i == 0:
+            if record.get("journal") != JOURNAL_VERSION or record.get("local") != str(local_dir):
+                return None
+        elif "plan" in record:
+            plan[record["plan"][1]] = record["plan"]
+        elif "done" in record:
+            done.add(record["done"])
+        elif "end" in record:
+            complete = True
+    if not complete:
+        return None
+    return [entry for rel, entry in plan.items() if rel not in done]
+
+# OSErrors already name what failed; anything else is a bug, so its type is kept
+def describe_error(e: Exception) -> str:
+    return str(e) if isinstance(e, OSError) else f"{type(e).__name__}: {e}"
+
+def has_pending_journal(base_dir: Path) -> bool:
+    return (base_dir / JOURNAL_NAME).exists()
+
+# in-progress transfers are named after the source size and mtime so a later sync
+# only resumes a partial file that belongs to the same version of the source
+def partial_path(dest: Path, size, mtime) -> Path:
+    return dest.with_name(f".musync-{dest.name}.{size:x}-{int(mtime):x}.part")
+
+# (dest name, size, mtime) of a partial_path name, or None for any other file
+def parse_partial(name):
+    if not (name.startswith(".musync-") and name.endswith(".part")):
+        return None
+    target, _, version = name[len(".musync-"):-len(".part")].rpartition(".")
+    size, _, mtime = version.partition("-")
+    try:
+        return target, int(size, 16), int(mtime, 16)
+    except ValueError:
+        return None
+
+# drops partial files of earlier versions of dest; they would never be resumed
+def remove_stale_partials(dest: Path, keep: Path):
+    try:
+        with os.scandir(dest.parent) as entries:
+            for entry in entries:
+                parsed = parse_partial(entry.name)
+                if parsed and parsed[0] == dest.name and entry.name != keep.name:
+                    try: os.remove(entry.path)
+                    except OSError: pass
+    except OSError:
+        pass
+
+# marks the device for a partial file sweep; a failed or cancelled copy, or a sync that
+# resumes after being cut off, may have left partial files
+def mark_partials(base_dir: Path):
+    try:
+        open(base_dir / PARTIALS_MARKER, "a").close()
+    except OSError:
+        pass
+
+# partial files under base_dir that no wanted transfer would resume: their file is gone from
+# the library or changed since. Scans never list partial files, so this walks the device;
+# it is only called while PARTIALS_MARKER is set. Transcoded targets are kept by name, their
+# encoded size isn't known before the encode. Returns (stale, number of partial files found).
+def find_stale_partials(base_dir: Path, local_files, transcoder: Transcoder | None = None) -> tuple[list[str], int]:
+    targets = device_names(local_files, transcoder)
+    stale, found = [], 0
+    for dirpath, _dirs, names in os.walk(base_dir):
+        rel_dir = os.path.relpath(dirpath, base_dir).replace(os.sep, "/")
+        prefix = "" if rel_dir == "." else rel_dir + "/"
+        for name in names:
+            parsed = parse_partial(name)
+            if parsed is None: continue
+            found += 1
+            target = prefix + parsed[0]
+            if target in local_files and not (transcoder and transcoder.applies(target)):
+                size, mtime = local_files[target][:2]
+                wanted = parsed[1:] == (size, int(mtime))
+            else:
+                wanted = target in targets
+            if not wanted: stale.append(prefix + name)
+    return stale, found
+
+# reserves size bytes for an open file without changing its length, so the filesystem can
+# allocate it in one contiguous run instead of growing the cluster chain chunk by chunk.
+# Best effort: filesystems without support are left to allocate as the data arrives.
+def preallocate(f, size):
+    try:
+        import ctypes
+        if sys.platform == "win32":
+            import msvcrt
+            # FILE_ALLOCATION_INFO, FileAllocationInfo = 5
+            info = ctypes.c_longlong(size)
+            ctypes.windll.kernel32.SetFileInformationByHandle(ctypes.c_void_p(msvcrt.get_osfhandle(f.fileno())), 5,
+                                                              ctypes.byref(info), ctypes.sizeof(info))
+        elif sys.platform.startswith("linux"):
+            # not os.posix_fallocate: glibc emulates that by writing every block where unsupported
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            libc.fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, 0, size)
+    except (OSError, AttributeError):
+        pass
+
+# copies src to dest through a temp file that is renamed into place once complete, so an
+# interrupted copy never leaves a truncated track at dest. Returns the content hash of what
+# was written, taken from the stream (same as hash_file), or None if cancelled, leaving the
+# partial file to be resumed next time. Without sync the data is left for the OS to flush.
+def copy_file(src: Path, dest: Path, size, mtime, on_bytes=None, cancelled=None,
+              chunk_size=COPY_CHUNK_SIZE, sync=True) -> str | None:
+    part = partial_path(dest, size, mtime)
+    try:
+        offset = os.path.getsize(part)
+    except OSError:
+        offset = 0
+        remove_stale_partials(dest, part)
+    # the tail of an interrupted write may never have reached the disk; redo the last chunk
+    offset = max(0, (min(offset, size) // chunk_size - 1) * chunk_size)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    h = hashlib.blake2b(digest_size=16)
+    with open(src, "rb") as fsrc, open(part, "r+b" if offset else "wb") as fdst:
+        # a resumed copy hashes the part already written from the local source
+        for _ in range(offset // chunk_size):
+            h.update(view[:fsrc.readinto(buf)])
+        fdst.seek(offset)
+        fdst.truncate()
+        if size - offset >= PREALLOCATE_MIN_BYTES:
+            preallocate(fdst, size)
+        while n := fsrc.readinto(buf):
+            fdst.write(view[:n])
+            h.update(view[:n])
+            if on_bytes: on_bytes(n)
+            if cancelled and cancelled(): return None
+        fdst.flush()
+        if sync: os.fsync(fdst.fileno())
+    shutil.copystat(src, part)
+    # the mtime the manifest records; a cached encode may carry an older one than its source
+    os.utime(part, (mtime, mtime))
+    os.replace(part, dest)
+    return h.hexdigest()
+
+# decides what to do with one local file: "copy" when it is missing on the device,
+# "update" when its size or mtime changed, "skip" otherwise. With a hash cache,
+# same-size files whose mtime moved are compared by content before being updated;
+# touch brings the device copy's mtime and manifest entry in line when they match.
+def plan_file(local_dir: Path, rel, size, mtime, device_dir: Path, device_files, hashes: HashCache | None = None, touch=True) -> str:
+    entry = device_files.get(rel)
+    if entry is None:
+        return "copy"
+    if entry[0] != size:
+        return "update"
+    if abs(entry[1] - mtime) <= MTIME_TOLERANCE:
+        return "skip"
+    if hashes is None:
+        return "update"
+    local_hash = hashes.get(local_dir, rel, size, mtime)
+    try:
+        device_hash = entry[2] if len(entry) > 2 and entry[2] else hash_file(device_dir / rel)
+    except OSError:
+        device_hash = None
+    if local_hash != device_hash:
+        return "update"
+    if touch:
+        try:
+            os.utime(device_dir / rel, (mtime, mtime))
+        except OSError:
+            pass
+        device_files[rel] = manifest_entry(size, mtime, local_hash, entry[3] if len(entry) > 3 else None)
+    return "skip"
+
+# the same decision for a file the device gets transcoded: the device copy carries the source
+# mtime, and the manifest records which settings and source size produced it
+def plan_transcoded(rel, size, mtime, device_files, transcoder: Transcoder) -> str:
+    entry = device_files.get(transcoder.target(rel))
+    if entry is None:
+        return "copy"
+    if abs(entry[1] - mtime) > MTIME_TOLERANCE:
+        return "update"
+    # entries from a rescanned device have no source slot; trust the mtime then
+    return "skip" if len(entry) < 5 or entry[4] == f"{transcoder.tag}:{size}" else "update"
+
+# device files that no longer exist locally
+def find_orphans(device_files, local_files) -> list[str]:
+    return sorted(rel for rel in device_files if rel not in local_files)
+
+# full plan computed up front without changing the device, as JSON-ready dicts:
+# {"action", "path", "size"} plus "from" for moves
+def plan_sync(local_dir: Path, local_files, device_dir: Path, device_files, hashes: HashCache | None = None,
+              compare_hash=False, mirror=False, detect_moves=False, transcoder: Transcoder | None = None) -> list[dict]:
+    plan, copies = [], []
+    for rel, (size, mtime) in local_files.items():
+        if transcoder and transcoder.applies(rel):
+            action = plan_transcoded(rel, size, mtime, device_files, transcoder)
+            step = {"action": action, "path": rel, "size": size}
+            plan.append({**step, "to": transcoder.target(rel)} if action != "skip" else step)
+            continue
+        action = plan_file(local_dir, rel, size, mtime, device_dir, device_files,
+                           hashes if compare_hash else None, touch=False)
+        if action == "copy" and detect_moves:
+            copies.append((action, rel, size, mtime))
+        else:
+            plan.append({"action": action, "path": rel, "size": size})
+    orphans = find_orphans(device_files, device_names(local_files, transcoder))
+    if copies:
+        moves, copies = match_moves(local_dir, device_dir, device_files, copies, orphans, hashes)
+        moved = {old for old, _ in moves}
+        orphans = [rel for rel in orphans if rel not in moved]
+        plan.extend({"action": "move", "path": item[1], "from": old, "size": item[2]} for old, item in moves)
+        plan.extend({"action": "copy", "path": rel, "size": size} for _action, rel, size, _mtime in copies)
+    if mirror:
+        plan.extend({"action": "delete", "path": rel, "size": device_files[rel][0]} for rel in orphans)
+    return plan
+
+# the names local files have on the device
+def device_names(local_files, transcoder: Transcoder | None = None):
+    return {transcoder.target(rel) for rel in local_files} if transcoder else local_files
+
+# orders transfers (action, rel, size, mtime) folder by folder, so each folder's directory
+# table on the device is written in one run instead of being revisited between other
+# folders; the order within a folder is kept
+def group_by_folder(items) -> list:
+    return sorted(items, key=lambda item: item[1].rpartition("/")[0].casefold())
+
+# deletes orphans in one pass, then removes the folders they leave empty, deepest first.
+# Returns (deleted, failed) lists and drops deleted entries from device_files.
+def prune_device_files(base_dir: Path, orphans, device_files):
+    deleted, failed = [], []
+    for rel in orphans:
+        try:
+            os.remove(base_dir / rel)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            failed.append(f"{rel} ({e})")
+            continue
+        device_files.pop(rel, None)
+        deleted.append(rel)
+    remove_empty_parents(base_dir, deleted)
+    return deleted, failed
+
+# removes the folders that removing rels may have emptied, deepest first
+def remove_empty_parents(base_dir: Path, rels):
+    parents = set()
+    for rel in rels:
+        parent = rel.rpartition("/")[0]
+        while parent and parent not in parents:
+            parents.add(parent)
+            parent = parent.rpartition("/")[0]
+    for rel_dir in sorted(parents, key=lambda d: d.count("/"), reverse=True):
+        try:
+            os.rmdir(base_dir / rel_dir)
+        except OSError:
+            pass  # not empty
+
+# pairs planned copies (action, rel, size, mtime) with device-only files of identical
+# content: candidates must share the size and partial hash, and a full hash is only
+# computed when several of them do. Returns (moves, unmatched) where moves are
+# (old rel, copy item) pairs.
+def match_moves(local_dir: Path, device_dir: Path, device_files, copies, orphans, hashes: HashCache):
+    by_size = {}
+    for rel in orphans:
+        by_size.setdefault(device_files[rel][0], []).append(rel)
+
+    def device_hash(rel, index, compute):
+        entry = device_files[rel]
+        if len(entry) <= index or not entry[index]:
+            digest = compute(device_dir / rel)
+            padded = entry + [None] * (4 - len(entry))
+            padded[index] = digest
+            device_files[rel] = manifest_entry(*padded)
+            return digest
+        return entry[index]
+
+    moves, unmatched = [], []
+    for item in copies:
+        _action, rel, size, mtime = item
+        candidates = by_size.get(size)
+        matches = []
+        if candidates:
+            try:
+                local_partial = hashes.partial(local_dir, rel, size, mtime)
+                matches = [c for c in candidates if device_hash(c, 3, lambda p: partial_hash(p, size)) == local_partial]
+                if len(matches) > 1:
+                    local_full = hashes.get(local_dir, rel, size, mtime)
+                    matches = [c for c in matches if device_hash(c, 2, hash_file) == local_full]
+            except OSError:
+                matches = []
+        if matches:
+            candidates.remove(matches[0])
+            moves.append((matches[0], item))
+        else:
+            unmatched.append(item)
+    return moves, unmatched
+
+def disk_free(path: Path) -> int:
+    return shutil.disk_usage(path).free
+
+def cluster_size(path: Path) -> int:
+    try:
+        return os.statvfs(path).f_frsize or DEFAULT_CLUSTER_SIZE
+    except (AttributeError, OSError):
+        return DEFAULT_CLUSTER_SIZE
+
+# when a file was added to the library: its creation time where the OS keeps one, else its mtime
+def added_time(path: Path) -> float:
+    st = os.stat(path)
+    return getattr(st, "st_birthtime", st.st_ctime if sys.platform == "win32" else st.st_mtime)
+
+# orders planned transfers (action, rel, size, mtime) for a device that can't take them all:
+# "recent" puts the most recently added files first, "smallest" the smallest, and a list of
+# patterns the files matching earlier patterns; ties and "library" keep the planned order
+def rank_transfers(items, priority, local_dir: Path) -> list:
+    if priority == "smallest":
+        return sorted(items, key=lambda item: item[2])
+    if priority == "recent":
+        def added(item):
+            try: return added_time(local_dir / item[1])
+            except OSError: return 0
+        return sorted(items, key=added, reverse=True)
+    if isinstance(priority, list):
+        def rank(item):
+            return next((i for i, pattern in enumerate(priority) if fnmatch.fnmatch(item[1], pattern)), len(priority))
+        return sorted(items, key=rank)
+    return list(items)
+
+# takes ranked transfers while they fit in budget bytes, cost(item) being the space one needs.
+# A file too large to fit doesn't stop smaller ones after it. Returns (selected, left out).
+def fit_transfers(items, budget, cost):
+    selected, left_out = [], []
+    for item in items:
+        need = cost(item)
+        if need <= budget:
+            budget -= need
+            selected.append(item)
+        else:
+            left_out.append(item)
+    return selected, left_out
+
+# renames a device file to its new library path and retargets its manifest entry
+def move_device_file(device_dir: Path, old, new, size, mtime, device_files):
+    dest = device_dir / new
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(device_dir / old, dest)
+    entry = device_files.pop(old)
+    if abs(entry[1] - mtime) > MTIME_TOLERANCE:
+        os.utime(dest, (mtime, mtime))
+    device_files[new] = manifest_entry(size, mtime, *entry[2:])
+
+# maps config.json keys onto SyncEngine keyword arguments
+def options_from_config(config) -> dict:
+    return {
+        "compare_hash": bool(config.get("COMPARE_HASH", False)),
+        "copy_workers": max(1, int(config.get("COPY_WORKERS", DEFAULT_COPY_WORKERS))),
+        "full_rescan_hours": float(config.get("FULL_RESCAN_HOURS", DEFAULT_FULL_RESCAN_HOURS)),
+        "mirror": bool(config.get("MIRROR_MODE", False)),
+        "delete_cap": int(config.get("MIRROR_DELETE_CAP", DEFAULT_DELETE_CAP)),
+        "detect_moves": bool(config.get("DETECT_MOVES", True)),
+        "profile": bool(config.get("PROFILE_SYNC", False)),
+        "include": list(config.get("INCLUDE", [])),
+        "exclude": list(config.get("EXCLUDE", [])),
+        "transcode": transcode_options(config),
+        "verify_hours": float(config.get("VERIFY_HOURS", DEFAULT_VERIFY_HOURS)),
+        "priority": config.get("FILL_PRIORITY", "library"),
+        "space_reserve_mb": int(config.get("SPACE_RESERVE_MB", DEFAULT_SPACE_RESERVE_MB)),
+        "auto_tune": bool(config.get("AUTO_TUNE", True)),
+        "throttle_mb": float(config.get("THROTTLE_MB_S", 0)),
+    }
+
+# TRANSCODE is {"FORMATS": [source extensions], "CODEC": "aac", "BITRATE": "256k"}, usually per
+# device; the cache size, encoder count and ffmpeg path are shared by all of them
+def transcode_options(config) -> dict | None:
+    settings = config.get("TRANSCODE") or {}
+    if not settings.get("FORMATS"):
+        return None
+    return {
+        "formats": list(settings["FORMATS"]),
+        "codec": settings.get("CODEC", "aac"),
+        "bitrate": str(settings.get("BITRATE", "256k")),
+        "cache_mb": int(config.get("TRANSCODE_CACHE_MB", DEFAULT_CACHE_MB)),
+        "workers": int(config.get("TRANSCODE_WORKERS", 0)) or None,
+        "ffmpeg": config.get("FFMPEG", "ffmpeg"),
+    }
+
+# Scans source, plans against the device state under dest and copies, moves and deletes
+# files to match. Progress is reported as the tuples the tray app's progress_queue
+# understands:
+#   ("init", total or None), ("total", files, planned bytes), ("bytes", n), ("log", text),
+#   ("progress", idx, copied, skipped, text), ("done", counts)
+# cancelled() is polled to stop early; confirm_delete(orphans) is asked before a mirror
+# cleanup larger than delete_cap and refuses it when not given.
+# Wall time is recorded per phase and per I/O operation (summed over copy workers); with
+# report a JSON report is written to REPORT_DIR after each run, and with profile the sync
+# thread runs under cProfile and its stats are dumped to PROFILE_FILE.
+# Syncs to several devices at once pass the same SharedLibrary so the library is scanned once;
+# without one the scan is streamed into the sync. name tells their reports apart.
+# Every copy is hashed as it is written and the checksum recorded in the device's
+# DeviceChecksums, which verify() later reads the device back against.
+# Transfers are only started during the scan while they surely fit in the device's free
+# space; otherwise they are held until the plan is complete, then ranked by priority
+# (see rank_transfers) and the ones that don't fit are left out ("nospace").
+# With auto_tune the device's I/O profile (see ioTuning.calibrate) sets the copy buffer,
+# starting worker count and fsync policy; without one the device is calibrated first and
+# on_io_profile(profile) is called so it can be kept. The worker count is then adjusted on
+# the measured MB/s, and throttle_mb caps the write rate.
+# With transcode settings, files of the listed formats are encoded through the transcode
+# cache (shared through the library when there is one) and the device gets the encoded copy.
+class SyncEngine:
+    LABELS = {"copy": "Copied", "update": "Updated", "move": "Moved", "skip": "Skipped", "failed": "Failed",
+              "nospace": "No space"}
+
+    def __init__(self, source, dest, compare_hash=False, copy_workers=DEFAULT_COPY_WORKERS,
+                 full_rescan_hours=DEFAULT_FULL_RESCAN_HOURS, mirror=False, delete_cap=DEFAULT_DELETE_CAP,
+                 detect_moves=True, state_dir=".", on_event=None, cancelled=None, confirm_delete=None,
+                 report=False, profile=False, include=(), exclude=(), library=None, name=None, transcode=None,
+                 verify_hours=DEFAULT_VERIFY_HOURS, priority="library", space_reserve_mb=DEFAULT_SPACE_RESERVE_MB,
+                 auto_tune=False, io_profile=None, on_io_profile=None, throttle_mb=0):
+        self.source = Path(source)
+        self.dest = Path(dest)
+        self.compare_hash = compare_hash
+        self.copy_workers = max(1, copy_workers)
+        self.full_rescan_hours = full_rescan_hours
+        self.mirror = mirror
+        self.delete_cap = delete_cap
+        self.detect_moves = detect_moves
+        self.state_dir = state_dir
+        self.on_event = on_event
+        self.cancelled = cancelled
+        self.confirm_delete = confirm_delete
+        self.report = report
+        self.profile = profile
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.library = library
+        self.name = name
+        self.transcode = transcode
+        self.verify_hours = verify_hours
+        self.priority = priority
+        self.space_reserve = space_reserve_mb * 2**20
+        self.auto_tune = auto_tune
+        self.io_profile = io_profile
+        self.on_io_profile = on_io_profile
+        self.throttle = Throttle(throttle_mb) if throttle_mb else None
+        self.tuner = None
+        self.chunk_size = COPY_CHUNK_SIZE
+        self.fsync = "file"
+        self.checksums = None
+        self.transcoder = None
+        self.shadows = {}
+        self.encodes = {}
+        # device folders known to exist, relative to dest; filled from the manifest so copies
+        # into existing folders don't cost a mkdir round-trip each
+        self.dirs = set()
+        self.counts = {"copy": 0, "update": 0, "move": 0, "skip": 0, "failed": 0, "nospace": 0, "delete": 0}
+        self.bytes_copied = 0
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.seconds = 0.0
+        self.phases = {}
+        self.io = {}
+        self.slowest = []
+        self.errors = []
+        self.error = None
+
+    def emit(self, *event):
+        if self.on_event: self.on_event(event)
+
+    def is_cancelled(self) -> bool:
+        return bool(self.cancelled and self.cancelled())
+
+    def state_path(self, name) -> str:
+        return os.path.join(self.state_dir, name)
+
+    def hash_cache(self) -> HashCache | None:
+        if not (self.compare_hash or self.detect_moves or self.transcode):
+            return None
+        return self.library.hashes if self.library else HashCache(self.state_path(HASH_CACHE_FILE))
+
+    # the encoded copies are keyed by content hash, so transcoding needs the hash cache
+    def make_transcoder(self, hashes) -> Transcoder | None:
+        settings = self.transcode
+        if not settings:
+            return None
+        if settings["codec"] not in CODECS:
+            self.emit("log", f"Transcoding off: unknown codec {settings['codec']}")
+            return None
+        if self.library:
+            cache = self.library.transcode_cache(settings)
+        else:
+            cache = TranscodeCache(self.state_path(TRANSCODE_DIR), settings["cache_mb"] * 2**20,
+                                   settings["workers"], settings["ffmpeg"])
+        if not cache.available:
+            self.emit("log", f"Transcoding off: {settings['ffmpeg']} not found, copying originals")
+            if not self.library: cache.close()
+            return None
+        return Transcoder(cache, hashes, self.source, settings["formats"], settings["codec"], settings["bitrate"])
+
+    def close_transcoder(self):
+        if self.transcoder:
+            if self.library: self.transcoder.cache.save()
+            else: self.transcoder.cache.close()
+
+    def wanted(self, rel) -> bool:
+        return matches_filters(rel, self.include, self.exclude) and not self.shadowed(rel)
+
+    # the library file whose device name a transcoded rel would overwrite; such files are left
+    # out of the sync. Memoized in self.shadows, which the sync logs once the scan is done.
+    def shadowed(self, rel) -> str | None:
+        if not (self.transcoder and self.transcoder.applies(rel)):
+            return None
+        if rel not in self.shadows:
+            self.shadows[rel] = self.transcoder.shadowed_by(
+                rel, lambda other: self.wanted(other) and os.path.isfile(self.source / other))
+        return self.shadows[rel]
+
+    def local_files(self, files) -> dict[str, list]:
+        if not (self.include or self.exclude or self.transcoder):
+            return files
+        return {rel: stat for rel, stat in files.items() if self.wanted(rel)}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - started
+
+    # adds one timed operation to io[name] = [count, seconds]; called from the copy workers too
+    def timed(self, name, seconds):
+        with self.lock:
+            entry = self.io.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def failed(self, message):
+        self.counts["failed"] += 1
+        if len(self.errors) < REPORT_ERRORS: self.errors.append(message)
+
+    def stats(self) -> dict:
+        seconds = max(self.seconds, 1e-9)
+        transferred = sum(self.counts.get(key, 0) for key in ("copy", "update", "verified"))
+        return {"name": self.name, "source": str(self.source), "dest": str(self.dest), "started_at": self.started_at,
+                "counts": dict(self.counts), "bytes_copied": self.bytes_copied, "seconds": round(self.seconds, 3),
+                "files_per_second": round(transferred / seconds, 2),
+                "mb_per_second": round(self.bytes_copied / seconds / 2**20, 2),
+                "phases": {name: round(t, 3) for name, t in self.phases.items()},
+                "io": {name: {"count": n, "seconds": round(t, 3)} for name, (n, t) in self.io.items()},
+                "slowest": [{"path": rel, "size": size, "seconds": round(t, 3)} for t, rel, size in sorted(self.slowest, reverse=True)],
+                "workers": self.tuner.workers if self.tuner else self.copy_workers, "io_profile": self.io_profile,
+                "errors": list(self.errors), "error": self.error}
+
+    def phase_summary(self) -> str:
+        return "Timing: " + ", ".join(f"{name} {t:.1f}s" for name, t in self.phases.items()) + \
+               f" ({format_bytes(self.bytes_copied / max(self.seconds, 1e-9))}/s)"
+
+    # writes stats() to REPORT_DIR/sync-<start time>.json and keeps the newest REPORT_KEEP reports
+    def write_report(self):
+        folder = self.state_path(REPORT_DIR)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            name = time.strftime("sync-%Y%m%d-%H%M%S", time.localtime(self.started_at))
+            name += f"-{self.name}.json" if self.name else ".json"
+            with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+                json.dump(self.stats(), f, indent=2)
+            reports = sorted(n for n in os.listdir(folder) if n.startswith("sync-") and n.endswith(".json"))
+            for old in reports[:-REPORT_KEEP]:
+                os.remove(os.path.join(folder, old))
+        except OSError:
+            pass
+
+    # dry run: the full plan for the current library and device, nothing on the device changes
+    def plan(self) -> list[dict]:
+        if self.library:
+            snapshot = self.library.snapshot
+            files = self.library.files()
+        else:
+            snapshot = LibrarySnapshot(self.source, self.state_path(SNAPSHOT_FILE), self.full_rescan_hours)
+            for _ in snapshot.scan(): pass
+            files = snapshot.files()
+        device_files = load_device_files(self.dest) if self.dest.is_dir() else {}
+        hashes = self.hash_cache()
+        self.transcoder = self.make_transcoder(hashes)
+        try:
+            plan = plan_sync(self.source, self.local_files(files), self.dest, device_files, hashes,
+                             self.compare_hash, self.mirror and not snapshot.unreadable, self.detect_moves, self.transcoder)
+            if self.dest.is_dir():
+                # deletions free their space before the transfers start
+                freed = sum(step["size"] for step in plan if step["action"] == "delete")
+                transfers = [(step["action"], step["path"], step["size"], None) for step in plan
+                             if step["action"] in ("copy", "update")]
+                _selected, left_out = fit_transfers(rank_transfers(transfers, self.priority, self.source),
+                                                    disk_free(self.dest) + freed - self.space_reserve,
+                                                    self.space_cost(device_files, cluster_size(self.dest)))
+                left_out = {item[1] for item in left_out}
+                for step in plan:
+                    if step["path"] in left_out and step["action"] in ("copy", "update"): step["action"] = "nospace"
+            return plan
+        finally:
+            if hashes: hashes.save()
+            self.close_transcoder()
+
+    def run(self) -> dict:
+        self.started_at = time.time()
+        started = time.monotonic()
+        profiler = None
+        if self.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            self.sync()
+        except Exception as e:
+            # anything unexpected still ends in "done", so the tray never waits on a dead sync
+            self.error = describe_error(e)
+            self.emit("log", f"Sync failed: {self.error}")
+        finally:
+            self.seconds = time.monotonic() - started
+            if profiler:
+                profiler.disable()
+                try: profiler.dump_stats(self.state_path(PROFILE_FILE))
+                except OSError: pass
+        if self.report:
+            self.write_report()
+        self.emit("log", self.phase_summary())
+        self.emit("done", self.counts)
+        return self.counts
+
+    # cost function for fit_transfers: the clusters a transfer adds to the device, less those
+    # of the copy it replaces. Transcoded files are counted at their source size.
+    def space_cost(self, usb_files, cluster):
+        def cost(item):
+            action, rel, size, _mtime = item
+            clusters = lambda n: -(-n // cluster) * cluster
+            old = usb_files.get(self.transcoder.target(rel) if self.transcoder else rel)
+            return max(0, clusters(size) - clusters(old[0])) if action == "update" and old else clusters(size)
+        return cost
+
+    # ranks the held transfers and keeps those that fit in what is free now, less what the
+    # transfers already running will still write
+    def fit_to_device(self, todo, pending, usb_files, report):
+        cost = self.space_cost(usb_files, cluster_size(self.dest))
+        budget = disk_free(self.dest) - self.space_reserve - sum(cost(item) for item in pending.values())
+        selected, left_out = fit_transfers(rank_transfers(todo, self.priority, self.source), budget, cost)
+        todo.clear()
+        todo.extend(selected)
+        if left_out:
+            self.emit("log", f"{len(left_out)} files ({format_bytes(sum(item[2] for item in left_out))}) "
+                             f"don't fit on the device and were left out")
+            for item in left_out: report("nospace", *item[1:])
+        return sum(item[2] for item in left_out)
+
+    # applies the device's I/O profile, calibrating the device when it has none yet
+    def tune(self):
+        if not self.auto_tune: return
+        profile = self.io_profile
+        if not profile:
+            self.emit("log", "Measuring the device's write speed...")
+            with self.phase("calibrate"):
+                profile = calibrate(self.dest, self.is_cancelled)
+            if profile is None: return
+            self.io_profile = profile
+            if not profile["read_ok"]:
+                self.emit("log", "Warning: the device returned different data than was written to it")
+            if self.on_io_profile: self.on_io_profile(profile)
+        self.chunk_size = profile["buffer_kb"] * 1024
+        self.copy_workers = profile["workers"]
+        self.fsync = profile["fsync"] if hasattr(os, "sync") else "file"
+        self.tuner = ConcurrencyTuner(self.copy_workers, MAX_WORKERS)
+        self.emit("log", f"Device profile: {profile['buffer_kb']} KB buffer, {self.copy_workers} "
+                         f"worker{'s' if self.copy_workers != 1 else ''}, fsync per {self.fsync}, "
+                         f"{profile['write_mb_s']} MB/s measured")
+
+    def on_bytes(self, n):
+        with self.lock:
+            self.bytes_copied += n
+        if self.tuner: self.tuner.add(n)
+        self.emit("bytes", n)
+        if self.throttle: self.throttle.consume(n)
+
+    def known_dirs(self, rels):
+        for rel in rels:
+            parent = rel.rpartition("/")[0]
+            while parent and parent not in self.dirs:
+                self.dirs.add(parent)
+                parent = parent.rpartition("/")[0]
+
+    def ensure_dir(self, target):
+        rel_dir = target.rpartition("/")[0]
+        if not rel_dir or rel_dir in self.dirs: return
+        started = time.monotonic()
+        (self.dest / rel_dir).mkdir(parents=True, exist_ok=True)
+        self.timed("mkdir", time.monotonic() - started)
+        with self.lock:
+            self.known_dirs([target])
+
+    def copy_one(self, rel, size, mtime):
+        if self.is_cancelled(): return None
+        src, target = self.source/rel, rel
+        if self.transcoder and self.transcoder.applies(rel):
+            started = time.monotonic()
+            src = (self.encodes.pop(rel, None) or self.transcoder.fetch(rel, size, mtime)).result()
+            self.timed("transcode", time.monotonic() - started)
+            target, size = self.transcoder.target(rel), os.path.getsize(src)
+        dest = self.dest/target
+        self.ensure_dir(target)
+        copying = time.monotonic()
+        try:
+            digest = copy_file(src, dest, size, mtime, self.on_bytes, self.is_cancelled, self.chunk_size, self.fsync == "file")
+        except FileNotFoundError:
+            if dest.parent.is_dir(): raise
+            # the folder was removed from the device behind the manifest's back
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            digest = copy_file(src, dest, size, mtime, self.on_bytes, self.is_cancelled, self.chunk_size, self.fsync == "file")
+        seconds = time.monotonic() - copying
+        self.timed("copy", seconds)
+        with self.lock:
+            if len(self.slowest) < SLOWEST_FILES: heapq.heappush(self.slowest, (seconds, rel, size))
+            else: heapq.heappushpop(self.slowest, (seconds, rel, size))
+        return digest
+
+    def sync(self):
+        if self.is_cancelled(): return
+        self.dest.mkdir(parents=True, exist_ok=True)
+        with self.phase("device"):
+            usb_files = load_device_files(self.dest)
+            checksums = self.checksums = DeviceChecksums(self.dest)
+            self.known_dirs(usb_files)
+        self.tune()
+        hashes = self.hash_cache()
+        compare = hashes if self.compare_hash else None
+        transcoder = self.transcoder = self.make_transcoder(hashes)
+        # copies whose size matches something already on the device wait for the end of the
+        # scan, when they can be matched against device-only files and applied as renames
+        device_sizes = {entry[0] for entry in usb_files.values()} if self.detect_moves else set()
+        deferred = []
+        cost = self.space_cost(usb_files, cluster_size(self.dest))
+        budget = disk_free(self.dest) - self.space_reserve
+        remaining = load_journal(self.dest, self.source)
+        resuming = remaining is not None
+        journal = SyncJournal(self.dest, self.source, resume=resuming, sync_data=self.fsync == "batch")
+        if resuming: mark_partials(self.dest)
+        counts = self.counts
+        if resuming:
+            total = len(remaining)
+            entries = self.resume_entries(remaining)
+            self.emit("init", total)
+            self.emit("total", total, sum(e[2] for e in remaining))
+        else:
+            # total is unknown until the local scan finishes; the UI shows an indeterminate bar until then
+            total = None
+            self.emit("init", None)
+            if self.library:
+                snapshot = self.library.snapshot
+                scan = self.library.scan()
+            else:
+                snapshot = LibrarySnapshot(self.source, self.state_path(SNAPSHOT_FILE), self.full_rescan_hours)
+                scan = snapshot.scan()
+            entries = stream_files(item for item in scan if self.wanted(item[0]))
+        # transfers start during the scan if everything the last listing has that the device lacks
+        # would fit; otherwise, or once the planned ones outgrow the free space, they are held and
+        # fitted to the device when the plan is complete. Without a last listing they only start
+        # early in library order, which is the order a fill by priority "library" picks them in.
+        if resuming:
+            hold = sum(cost(entry) for entry in remaining) > budget
+        else:
+            known = self.local_files(snapshot.files())
+            def missing(rel, size):
+                if transcoder and transcoder.applies(rel):
+                    return transcoder.target(rel) not in usb_files
+                return usb_files.get(rel, (None,))[0] != size
+            if known:
+                hold = sum(cost(("copy", rel, size, mtime)) for rel, (size, mtime) in known.items()
+                           if missing(rel, size)) > budget
+            else:
+                hold = self.priority != "library"
+        # copies and updates come with the checksum their copy was written with
+        def report(action, rel, size, mtime, future=None):
+            digest = None
+            try:
+                if future is not None and not (digest := future.result()):
+                    mark_partials(self.dest)
+                    return
+            except OSError as e:
+                mark_partials(self.dest)
+                action, rel = "failed", f"{rel} ({e})"
+            if action in ("copy", "update") and transcoder and transcoder.applies(rel):
+                target = transcoder.target(rel)
+                usb_files[target] = manifest_entry(os.path.getsize(self.dest / target), mtime, digest,
+                                                   source=f"{transcoder.tag}:{size}")
+                checksums.record(target, digest)
+                journal.completed(rel)
+            elif action in ("copy", "update"):
+                if hashes: hashes.remember(rel, size, mtime, digest)
+                started = time.monotonic()
+                partial = hashes.partial(self.source, rel, size, mtime) if self.detect_moves else None
+                if self.detect_moves: self.timed("hash", time.monotonic() - started)
+                usb_files[rel] = manifest_entry(size, mtime, digest, partial)
+                checksums.record(rel, digest)
+                journal.completed(rel)
+            if action == "failed": self.failed(rel)
+            else: counts[action] += 1
+            idx = sum(counts.values()) - counts["delete"]
+            where = f"{idx}/{total} - {int(idx/total*100)}%" if total else f"{idx}"
+            self.emit("progress", idx, counts["copy"], counts["skip"], f"{self.LABELS[action]}: {rel} ({where})")
+
+        # planning runs at scan speed and queues transfers in todo; only a bounded window of
+        # them is handed to the pool, so a 40k-file plan doesn't turn into 40k queued futures.
+        # When tuned, the window is exactly the tuner's worker count, so it sets the concurrency.
+        pool = ThreadPoolExecutor(max_workers=MAX_WORKERS if self.tuner else self.copy_workers)
+        pending = {}
+        todo = deque()
+        def pump(block=False):
+            if pending:
+                done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+                for f in done: report(*pending.pop(f), f)
+            window = self.tuner.update() if self.tuner else self.copy_workers * 2
+            while todo and len(pending) < window and not self.is_cancelled():
+                item = todo.popleft()
+                pending[pool.submit(self.copy_one, *item[1:])] = item
+            # start encoding what the copy workers get to next, so they don't wait on the encoder
+            if transcoder:
+                for _action, rel, size, mtime in itertools.islice(todo, transcoder.cache.workers):
+                    if rel not in self.encodes and transcoder.applies(rel):
+                        self.encodes[rel] = transcoder.fetch(rel, size, mtime)
+
+        scanned = planned_bytes = 0
+        finished = False
+        try:
+            # copies started during the scan overlap it, so "scan" includes some transfer time
+            with self.phase("scan"):
+                for rel, size, mtime in entries:
+                    if self.is_cancelled(): break
+                    scanned += 1
+                    if transcoder and transcoder.applies(rel):
+                        action = plan_transcoded(rel, size, mtime, usb_files, transcoder)
+                    else:
+                        action = plan_file(self.source, rel, size, mtime, self.dest, usb_files, compare)
+                    if action == "skip":
+                        report(action, rel, size, mtime)
+                        continue
+                    if action == "copy" and size in device_sizes and not resuming and not (transcoder and transcoder.applies(rel)):
+                        deferred.append((action, rel, size, mtime))
+                        continue
+                    if not resuming: journal.planned(action, rel, size, mtime)
+                    planned_bytes += size
+                    todo.append((action, rel, size, mtime))
+                    if not hold:
+                        budget -= cost(todo[-1])
+                        hold = budget < 0
+                    if not hold: pump()
+            if not resuming and not self.is_cancelled():
+                total = scanned
+                local_files = self.local_files(snapshot.files())
+                with self.phase("moves"):
+                    for item in self.apply_moves(usb_files, local_files, deferred, hashes, report):
+                        journal.planned(*item)
+                        planned_bytes += item[2]
+                        todo.append(item)
+                        budget -= cost(item)
+                hold = hold or budget < 0
+                journal.plan_complete(total)
+                if not self.library: snapshot.save()
+                self.emit("total", total, planned_bytes)
+                self.emit("log", f"Library: {len(snapshot.added)} added, {len(snapshot.modified)} modified, "
+                                 f"{len(snapshot.removed)} removed ({snapshot.rescanned} folders rescanned)")
+                for rel, other in sorted(self.shadows.items()):
+                    if other: self.emit("log", f"Not transcoded, {other} has the same name on the device: {rel}")
+                if self.mirror and snapshot.unreadable:
+                    self.emit("log", "Cleanup skipped, the library listing is incomplete: could not read "
+                                     + ", ".join(rel or str(self.source) for rel in snapshot.unreadable[:5]))
+                elif self.mirror:
+                    with self.phase("prune"):
+                        self.prune(usb_files, local_files)
+            if hold and not self.is_cancelled():
+                with self.phase("capacity"):
+                    planned_bytes -= self.fit_to_device(todo, pending, usb_files, report)
+                self.emit("total", total, planned_bytes)
+            with self.phase("transfer"):
+                ordered = group_by_folder(todo)
+                todo.clear()
+                todo.extend(ordered)
+                while (todo or pending) and not self.is_cancelled():
+                    pump(block=True)
+                for f in as_completed(list(pending)):
+                    report(*pending.pop(f), f)
+            finished = not self.is_cancelled()
+        finally:
+            with self.phase("finish"):
+                entries.close()
+                pool.shutdown(wait=True, cancel_futures=True)
+                # a resumed sync gets one attempt; failures are picked up by the next full plan
+                if finished and (resuming or not counts["failed"]):
+                    journal.discard()
+                else:
+                    journal.close()
+                # record whatever made it onto the device, even if the sync was cut short
+                if self.fsync == "batch": os.sync()
+                save_device_manifest(self.dest, usb_files)
+                checksums.save(keep=usb_files)
+                if hashes: hashes.save()
+                self.close_transcoder()
+
+    # applies renames for deferred copies that match device-only files; returns the copies left over
+    def apply_moves(self, usb_files, local_files, deferred, hashes, report):
+        if not deferred: return []
+        orphans = find_orphans(usb_files, device_names(local_files, self.transcoder))
+        moves, copies = match_moves(self.source, self.dest, usb_files, deferred, orphans, hashes)
+        moved = []
+        for old, (_action, rel, size, mtime) in moves:
+            try:
+                move_device_file(self.dest, old, rel, size, mtime, usb_files)
+            except OSError:
+                copies.append(("copy", rel, size, mtime))
+                continue
+            self.checksums.move(old, rel)
+            moved.append(old)
+            report("move", f"{old} -> {rel}", size, mtime)
+        remove_empty_parents(self.dest, moved)
+        return copies
+
+    def prune(self, usb_files, local_files):
+        if (self.dest / PARTIALS_MARKER).exists():
+            stale, found = find_stale_partials(self.dest, local_files, self.transcoder)
+            removed, _failed = prune_device_files(self.dest, stale, usb_files)
+            for rel in removed: self.emit("log", f"Removed unfinished copy: {rel}")
+            # partial files still to be resumed keep the marker for a later sweep
+            if len(removed) == found:
+                try: os.remove(self.dest / PARTIALS_MARKER)
+                except OSError: pass
+        orphans = find_orphans(usb_files, device_names(local_files, self.transcoder))
+        if not orphans: return
+        if len(orphans) > self.delete_cap and not (self.confirm_delete and self.confirm_delete(orphans)):
+            self.emit("log", f"Cleanup of {len(orphans)} device-only files skipped")
+            return
+        deleted, failed = prune_device_files(self.dest, orphans, usb_files)
+        self.counts["delete"] += len(deleted)
+        for rel in deleted: self.emit("log", f"Deleted: {rel}")
+        for rel in failed:
+            self.failed(f"delete {rel}")
+            self.emit("log", f"Failed to delete: {rel}")
+
+    # reads device files back and compares them with the checksums taken when they were
+    # copied, on copy_workers threads; incremental only reads files not verified within
+    # verify_hours. Corrupted and missing files are dropped from the manifest and checksums so
+    # the next sync copies them again over whatever is there; nothing on the device is deleted.
+    # Files that could not be read are only reported. Emits the same events as a sync, with counts of
+    # verified/mismatch/missing/failed and unchecked (files copied before checksums were kept).
+    def verify(self, incremental=False) -> dict:
+        self.started_at = time.time()
+        started = time.monotonic()
+        self.counts = {"verified": 0, "mismatch": 0, "missing": 0, "failed": 0, "unchecked": 0}
+        try:
+            self.verify_files(incremental)
+        except Exception as e:
+            self.error = describe_error(e)
+            self.emit("log", f"Verify failed: {self.error}")
+        self.seconds = time.monotonic() - started
+        if self.report: self.write_report()
+        self.emit("done", self.counts)
+        return self.counts
+
+    def verify_files(self, incremental):
+        counts = self.counts
+        checksums = DeviceChecksums(self.dest)
+        manifest = load_device_manifest(self.dest)
+        cutoff = time.time() - self.verify_hours * 3600 if incremental else float("inf")
+        todo = sorted(rel for rel, (_digest, when) in checksums.files.items() if when < cutoff)
+        if manifest: counts["unchecked"] = sum(1 for rel in manifest if rel not in checksums.files)
+        self.emit("init", len(todo))
+        self.emit("total", len(todo), None)
+
+        def check(rel):
+            if self.is_cancelled(): return None
+            path = self.dest / rel
+            begun = time.monotonic()
+            digest = hash_file(path)
+            self.timed("hash", time.monotonic() - begun)
+            self.on_bytes(os.path.getsize(path))
+            return digest
+
+        bad, pending, items = [], {}, iter(todo)
+        with self.phase("verify"), ThreadPoolExecutor(max_workers=self.copy_workers) as pool:
+            while True:
+                for rel in itertools.islice(items, self.copy_workers * 2 - len(pending)):
+                    pending[pool.submit(check, rel)] = rel
+                if not pending or self.is_cancelled(): break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    rel = pending.pop(f)
+                    try:
+                        digest = f.result()
+                        if digest is None: continue
+                        outcome = "verified" if digest == checksums.files[rel][0] else "mismatch"
+                    except FileNotFoundError:
+                        outcome = "missing"
+                    except OSError:
+                        outcome = "failed"
+                    counts[outcome] += 1
+                    if outcome == "verified":
+                        checksums.verified(rel, time.time())
+                    else:
+                        if outcome != "failed": bad.append((rel, outcome))
+                        if len(self.errors) < REPORT_ERRORS: self.errors.append(f"{outcome}: {rel}")
+                    idx = sum(counts.values()) - counts["unchecked"]
+                    self.emit("progress", idx, counts["verified"], 0,
+                              f"{'Verified' if outcome == 'verified' else outcome.capitalize()}: {rel} ({idx}/{len(todo)})")
+        with self.phase("finish"):
+            for rel, outcome in bad:
+                if outcome == "mismatch":
+                    # a manifest rebuilt by a device scan must not take the copy for current
+                    try: os.utime(self.dest / rel, (0, 0))
+                    except OSError: pass
+                checksums.forget(rel)
+                if manifest: manifest.pop(rel, None)
+            if bad and manifest is not None: save_device_manifest(self.dest, manifest)
+            checksums.save()
+        if bad: self.emit("log", f"{len(bad)} files are damaged or missing; the next sync copies them again")
+        if counts["failed"]: self.emit("log", f"{counts['failed']} files could not be read and were left as they are")
+        if counts["unchecked"]: self.emit("log", f"{counts['unchecked']} files have no checksum yet and were not checked")
+
+    # re-stats journaled entries so files edited since the interrupted sync are copied as they are now
+    def resume_entries(self, remaining):
+        for _action, rel, _size, _mtime in remaining:
+            try:
+                st = os.stat(self.source / rel)
+            except OSError:
+                continue
+            yield rel, st.st_size, st.st_mtime
+
+# wraps an event sink so a UI sees at most one update per interval instead of one event per
+# file or chunk:
+#   ("update", idx or None, copied, skipped, bytes since the last update, latest line, [new lines])
+# Only the last max_lines lines between updates are kept; every line also goes to log_path.
+# init, total and done are passed through after flushing what is pending.
+class ProgressCoalescer:
+    def __init__(self, sink, interval=PROGRESS_INTERVAL, max_lines=LOG_VIEW_LINES, log_path=None):
+        self.sink = sink
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.lines = deque(maxlen=max_lines)
+        self.state = (None, 0, 0)
+        self.current = ""
+        self.bytes = 0
+        self.dirty = False
+        self.last_flush = 0.0
+        self.log = None
+        if log_path:
+            try: self.log = open(log_path, "w", encoding="utf-8")
+            except OSError: pass
+
+    # called from the sync thread and, for bytes, from the copy workers
+    def __call__(self, event):
+        kind = event[0]
+        with self.lock:
+            if kind == "bytes":
+                self.bytes += event[1]
+            elif kind in ("progress", "log"):
+                if kind == "progress":
+                    self.state = event[1:4]
+                    self.current = event[4]
+                self.lines.append(event[-1])
+                if self.log:
+                    try: self.log.write(event[-1] + "\n")
+                    except OSError: self.log = None
+            else:
+                self.flush()
+                if kind == "done": self.close()
+                self.sink(event)
+                return
+            self.dirty = True
+            if time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    def flush(self):
+        if not self.dirty: return
+        self.sink(("update", *self.state, self.bytes, self.current, list(self.lines)))
+        self.lines.clear()
+        self.bytes = 0
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.log:
+            try: self.log.close()
+            except OSError: pass
+            self.log = None
+
+def print_event(event):
+    if event[0] == "log" or (event[0] == "progress" and not event[4].startswith("Skipped")):
+        print(event[-1], file=sys.stderr, flush=True)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="syncEngine", description="Sync a local music folder to a device folder.")
+    parser.add_argument("source", help="local music folder")
+    parser.add_argument("dest", help="remote folder on the device")
+    parser.add_argument("--config", help="read sync options from a muSync config.json")
+    parser.add_argument("--state-dir", help="folder for the hash cache and library snapshot (default: the config's folder, else the current one)")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without changing the device")
+    parser.add_argument("--verify", action="store_true", help="check the device files against their copy checksums instead of syncing")
+    parser.add_argument("--incremental", action="store_true", help="with --verify, only check files not verified recently")
+    parser.add_argument("--json", action="store_true", help="print stats, and the plan with --dry-run, as JSON on stdout; progress still goes to stderr")
+    parser.add_argument("--workers", type=int, help="concurrent copies")
+    parser.add_argument("--compare-hash", action="store_true", default=None, help="compare content when only the mtime changed")
+    parser.add_argument("--mirror", action="store_true", default=None, help="delete device files missing from the library")
+    parser.add_argument("--no-moves", action="store_true", help="copy moved files instead of renaming them on the device")
+    parser.add_argument("--include", action="append", help="only sync paths matching this pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", help="skip paths matching this pattern (repeatable)")
+    parser.add_argument("--yes", action="store_true", help="allow mirror deletions above the configured cap")
+    parser.add_argument("--tune", action="store_true", help="measure the device first and copy with the buffer, workers and fsync policy that suit it")
+    parser.add_argument("--throttle", type=float, help="cap the write rate at this many MB/s")
+    parser.add_argument("--report", action="store_true", help="write a timing report to sync_reports/ in the state folder")
+    parser.add_argument("--profile", action="store_true", default=None, help=f"profile the sync and write {PROFILE_FILE} to the state folder")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print per-file progress")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        try:
+            with open(args.config, "r") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read config {args.config}: {e}", file=sys.stderr)
+            return 1
+    options = options_from_config(config)
+    if args.workers is not None: options["copy_workers"] = args.workers
+    if args.compare_hash: options["compare_hash"] = True
+    if args.mirror: options["mirror"] = True
+    if args.no_moves: options["detect_moves"] = False
+    if args.profile: options["profile"] = True
+    # a calibration is only kept by the tray app, which knows the device's volume label
+    options["auto_tune"] = args.tune
+    if args.throttle is not None: options["throttle_mb"] = args.throttle
+    if args.include: options["include"] = args.include
+    if args.exclude: options["exclude"] = args.exclude
+    state_dir = args.state_dir or (os.path.dirname(os.path.abspath(args.config)) if args.config else ".")
+
+    if not os.path.isdir(args.source):
+        print(f"Local folder not found: {args.source}", file=sys.stderr)
+        return 1
+
+    engine = SyncEngine(args.source, args.dest, **options, state_dir=state_dir, report=args.report,
+                        on_event=None if args.quiet else print_event,
+                        confirm_delete=lambda orphans: args.yes)
+    try:
+        if args.verify:
+            counts = engine.verify(incremental=args.incremental)
+            if args.json:
+                print(json.dumps({"verify": True, **engine.stats()}, indent=2))
+            elif not args.quiet:
+                print(", ".join(f"{k}: {v}" for k, v in counts.items()) + f" ({engine.seconds:.1f}s)")
+            return 1 if engine.error or counts["mismatch"] or counts["missing"] or counts["failed"] else 0
+        if args.dry_run:
+            started = time.monotonic()
+            plan = engine.plan()
+            engine.seconds = time.monotonic() - started
+            for step in plan:
+                engine.counts[step["action"]] += 1
+            changes = [step for step in plan if step["action"] != "skip"]
+            if args.json:
+                print(json.dumps({"dry_run": True, "plan": changes, **engine.stats()}, indent=2))
+            else:
+                for step in changes:
+                    path = f"{step['from']} -> {step['path']}" if "from" in step else \
+                           f"{step['path']} -> {step['to']}" if "to" in step else step["path"]
+                    print(f"{step['action']:<7} {path}")
+                print(", ".join(f"{k}: {v}" for k, v in engine.counts.items()))
+            return 0
+        engine.run()
+    except KeyboardInterrupt:
+        return 130
+    if args.json:
+        print(json.dumps({"dry_run": False, **engine.stats()}, indent=2))
+    elif not args.quiet:
+        print(", ".join(f"{k}: {v}" for k, v in engine.counts.items())
+              + f" ({format_bytes(engine.bytes_copied)} in {engine.seconds:.1f}s)")
+    return 1 if engine.error or engine.counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,3 @@
-import ctypes
-import shutil
 import sys
 import os
 import threading
@@ -7,21 +5,19 @@ import time
 import queue
 import json
 from pathlib import Path
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog, scrolledtext
-import winsound
 import pystray
 from PIL import Image, ImageDraw
-import win32file
-import win32con
+from deviceWatcher import make_watcher, get_volume_label, mounted_volumes
+
+# Tk and the sync engine are imported on first use: until a window opens or a sync starts
+# the process is only the tray icon and the device watcher. load_ui() fills these in.
+tk = ttk = filedialog = scrolledtext = None
 
 CONFIG_FILE = "config.json"
-POLL_INTERVAL_SECONDS = 1
 
-USB_DRIVE = Path("U:/")
-USB_MUSIC = USB_DRIVE / "music"
 LOCAL_MUSIC = Path("C:/Users/beeman/Music/testing")
-EXPECTED_VOLUME_NAME = "IPOD"
+PROFILES = []
+DEVICE_WATCHER = "auto"
 
 # add shared style constants and update set_modern_style
 DARK_BG = "#23272e"
@@ -31,6 +27,54 @@ ENTRY_BG = "#2c313a"
 PATH_FG = "#4FC3F7"
 SECONDARY_BG = "#2f343b"
 
+# The top-level USB_DRIVE, REMOTE_FOLDER and EXPECTED_VOLUME_NAME keys describe the primary
+# device; DEVICES lists more. Each device has its own volume name, remote folder, INCLUDE and
+# EXCLUDE patterns and may override any sync option. Without USB_DRIVE a device is found by
+# its volume name on whatever drive it is mounted.
+def load_profiles(config) -> list[dict]:
+    profiles = []
+    entries = ([config] if config.get("EXPECTED_VOLUME_NAME") else []) + list(config.get("DEVICES", []))
+    for entry in entries:
+        label = entry["EXPECTED_VOLUME_NAME"]
+        profiles.append({
+            "name": entry.get("NAME", label),
+            "label": label,
+            "drive": Path(entry["USB_DRIVE"] + "/") if entry.get("USB_DRIVE") else None,
+            "remote": entry.get("REMOTE_FOLDER", ""),
+            "entry": entry,
+            "config": config,
+            "options": None,
+        })
+    return profiles
+
+# sync options of a profile, parsed by the engine the first time a sync needs them
+def profile_options(profile) -> dict:
+    if profile["options"] is None:
+        from syncEngine import options_from_config
+        entry, config = profile["entry"], profile["config"]
+        options = options_from_config({**config, **entry})
+        options["include"], options["exclude"] = list(entry.get("INCLUDE", [])), list(entry.get("EXCLUDE", []))
+        options["io_profile"] = config.get("IO_PROFILES", {}).get(profile["label"])
+        profile["options"] = options
+    return profile["options"]
+
+# read straight from the config so the tray menu can show it without loading the engine
+def mirror_enabled(profile) -> bool:
+    return bool({**profile["config"], **profile["entry"]}.get("MIRROR_MODE", False))
+
+def profile_named(name) -> dict:
+    return next(p for p in PROFILES if p["name"] == name)
+
+# remote folder of a profile on the drive it is mounted at; a folder saved with another
+# drive letter is moved onto the current one
+def device_folder(profile, root: Path) -> Path:
+    remote = Path(profile["remote"])
+    if not remote.is_absolute() and not remote.drive:
+        return root / remote
+    if remote.drive and remote.drive != root.drive:
+        return root / remote.relative_to(remote.anchor)
+    return remote
+
 def load_config():
     if os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, "r") as f:
@@ -41,28 +85,20 @@ def save_config(config):
     with open(CONFIG_FILE, "w") as f:
         json.dump(config, f, indent=4)
 
-def get_volume_label(drive: Path) -> str | None:
-    try:
-        buf = ctypes.create_unicode_buffer(1024)
-        success = ctypes.windll.kernel32.GetVolumeInformationW(
-            ctypes.c_wchar_p(str(drive)),
-            buf,
-            ctypes.sizeof(buf),
-            None,
-            None,
-            None,
-            None,
-            0,
-        )
-        return buf.value if success else None
-    except Exception:
-        return None
-
-def collect_local_files(base_dir: Path):
-    return [p for p in base_dir.rglob("*") if p.is_file()]
+# keeps a device's measured I/O profile in config.json under its volume label; called from
+# sync threads, so the config is re-read rather than overwritten with a stale copy
+config_lock = threading.Lock()
+def save_io_profile(label, profile):
+    with config_lock:
+        config = load_config() or {}
+        config.setdefault("IO_PROFILES", {})[label] = profile
+        save_config(config)
+    for p in PROFILES:
+        if p["label"] == label: profile_options(p)["io_profile"] = profile
 
 def eject_drive_windows(drive_letter: str) -> bool:
     try:
+        import win32con, win32file
         path = f"\\\\.\\{drive_letter.strip(':')}:"
         handle = win32file.CreateFile(
             path,
@@ -86,6 +122,30 @@ def create_image(drive_status: bool) -> Image.Image:
     d.ellipse((8,8,56,56), fill=color)
     return img
 
+def sync_summary(counts) -> str:
+    lines = [f"Copied: {counts['copy']}", f"Updated: {counts['update']}", f"Skipped: {counts['skip']}"]
+    for key, label in (("move", "Moved"), ("delete", "Deleted"), ("failed", "Failed"), ("nospace", "Left out, device full")):
+        if counts.get(key): lines.append(f"{label}: {counts[key]}")
+    return "\n".join(lines)
+
+def verify_summary(counts) -> str:
+    lines = [f"Intact: {counts['verified']}"]
+    for key, label in (("mismatch", "Corrupted"), ("missing", "Missing"), ("failed", "Unreadable")):
+        if counts[key]: lines.append(f"{label}: {counts[key]}")
+    if counts["mismatch"] or counts["missing"]:
+        lines.append("Damaged and missing files will be copied again on the next sync.")
+    if counts["failed"]:
+        lines.append("Unreadable files were left as they are; verify again to recheck them.")
+    if counts["unchecked"]:
+        lines.append(f"{counts['unchecked']} files were synced before checksums were kept and could not be checked.")
+    return "\n".join(lines)
+
+def preview_list(paths, limit=10) -> str:
+    text = "\n".join(paths[:limit])
+    if len(paths) > limit:
+        text += f"\n... and {len(paths) - limit} more"
+    return text
+
 def center_window(win, width=None, height=None):
     win.update_idletasks()
     if width is None: width = win.winfo_width()
@@ -95,6 +155,16 @@ def center_window(win, width=None, height=None):
     y = (sh - height) // 2
     win.geometry(f"{width}x{height}+{x}+{y}")
 
+# creates the hidden Tk root and the shared ttk styles; called once, for the first window
+def load_ui():
+    global tk, ttk, filedialog, scrolledtext
+    import tkinter as tk
+    from tkinter import ttk, filedialog, scrolledtext
+    root = tk.Tk()
+    root.withdraw()
+    set_modern_style()
+    return root
+
 def set_modern_style():
     style = ttk.Style()
     style.theme_use("clam")
@@ -132,7 +202,6 @@ def set_modern_style():
     # ensure any explicit widget bg for scrolledtext uses same scheme elsewhere
 
 def show_custom_message(parent, title, message, msg_type="info"):
-    set_modern_style()
     popup = tk.Toplevel(parent)
     popup.title(title)
     popup.resizable(False, False)
@@ -170,7 +239,6 @@ def show_custom_message(parent, title, message, msg_type="info"):
         popup.wait_window()
 
 def first_launch_setup(root):
-    set_modern_style()
     config = {}
     setup_win = tk.Toplevel(root)
     setup_win.title("First-Time Setup")
@@ -266,54 +334,131 @@ def refresh_drives(option_var, menu_widget):
     except Exception:
         pass
 
+# The tray and the device watcher run on their own threads from the start; the main thread
+# idles in run_ui() without Tk until something needs a window, then loads it and runs the Tk
+# main loop. Work for the UI thread goes through ui().
 class SyncApp:
-    def __init__(self, root):
+    def __init__(self, root=None):
         self.root = root
-        self.progress_queue = queue.Queue()
-        self.sync_running = False
-        self.synced_this_session = False
-        self.drive_present = False
+        self.ui_lock = threading.Lock()
+        self.ui_calls = queue.Queue()
+        self.present = {}
+        self.sessions = {}
+        self.prompting = set()
+        self.synced = set()
+        self.library = None
         self.shutdown_requested = False
 
-        set_modern_style()
-
+        # both tray icons are drawn once; the watcher only swaps them when the drive state changes
+        self.icons = {state: create_image(state) for state in (False, True)}
         self.tray_icon = pystray.Icon("music_sync")
-        self.tray_icon.icon = create_image(False)
+        self.tray_icon.icon = self.icons[False]
         self.tray_icon.title = "USB Music Sync"
         self.tray_icon.menu = pystray.Menu(
-            pystray.MenuItem("Sync Now", self.manual_sync, enabled=lambda item: not self.sync_running),
-            pystray.MenuItem("Settings", self.edit_settings),
+            pystray.MenuItem("Sync Now", self.manual_sync, enabled=lambda item: not self.present or bool(self.idle_devices())),
+            pystray.MenuItem("Preview Mirror Cleanup", self.preview_prune,
+                             visible=lambda item: any(mirror_enabled(p) for p in PROFILES),
+                             enabled=lambda item: bool(self.idle_devices())),
+            pystray.MenuItem("Verify Device", pystray.Menu(
+                pystray.MenuItem("Recently Unverified Files", lambda icon, item: self.verify_devices(True)),
+                pystray.MenuItem("All Files", lambda icon, item: self.verify_devices(False))),
+                enabled=lambda item: bool(self.idle_devices())),
+            pystray.MenuItem("Settings", lambda icon, item: self.ui(self.edit_settings)),
             pystray.MenuItem("Exit", self.exit_app)
         )
 
-        threading.Thread(target=self.usb_watcher, daemon=True).start()
+        self.watcher = make_watcher(self.check_device, self.on_device_change, DEVICE_WATCHER)
+        threading.Thread(target=self.watcher.run, daemon=True).start()
         threading.Thread(target=self.tray_run, daemon=True).start()
 
+    # runs fn on the UI thread, loading Tk first if no window has been needed yet
+    def ui(self, fn):
+        with self.ui_lock:
+            if self.root is None:
+                self.ui_calls.put(fn)
+                return
+        self.root.after(0, fn)
+
+    def run_ui(self):
+        if self.root is None:
+            fn = self.ui_calls.get()
+            if fn is None: return
+            root = load_ui()
+            with self.ui_lock:
+                self.root = root
+                pending = [fn]
+                while not self.ui_calls.empty(): pending.append(self.ui_calls.get())
+            for fn in pending:
+                if fn is None: return
+                root.after(0, fn)
+        self.root.mainloop()
+
+    def idle_devices(self) -> list[str]:
+        return [name for name in self.present if name not in self.sessions and name not in self.prompting]
+
     def manual_sync(self, icon=None, item=None):
-        if self.drive_present and not self.sync_running:
-            self.start_sync()
-        elif not self.drive_present:
-            show_custom_message(self.root, "No Device Detected", "No device detected.")
-
-    def usb_watcher(self):
-        while not self.shutdown_requested:
-            try:
-                drive_exists = USB_DRIVE.exists()
-            except OSError:
-                drive_exists = False
-            label = get_volume_label(USB_DRIVE) if drive_exists else None
-            prev = self.drive_present
-            self.drive_present = drive_exists and label == EXPECTED_VOLUME_NAME
-            self.tray_icon.icon = create_image(self.drive_present)
-            self.tray_icon.visible = True
-            if self.drive_present and not prev and not self.synced_this_session and not self.sync_running:
-                self.root.after(0, self.ask_to_sync)
-            elif not self.drive_present:
-                self.synced_this_session = False
-            time.sleep(POLL_INTERVAL_SECONDS)
+        def start():
+            if not self.present:
+                show_custom_message(self.root, "No Device Detected", "No device detected.")
+            for name in self.idle_devices():
+                self.start_sync(name)
+        self.ui(start)
+
+    # reads the attached devices back against the checksums taken when their files were copied
+    def verify_devices(self, incremental):
+        def start():
+            for name in self.idle_devices():
+                self.sessions[name] = SyncWindow(self, profile_named(name), self.present[name], len(self.sessions),
+                                                 verify="incremental" if incremental else "all")
+        self.ui(start)
+
+    # dry run of the mirror cleanup: lists what the next sync would delete without touching the drives
+    def preview_prune(self, icon=None, item=None):
+        def worker():
+            from syncEngine import SyncEngine
+            sections = []
+            for name in self.idle_devices():
+                profile, root = profile_named(name), self.present[name]
+                if not profile_options(profile)["mirror"]: continue
+                plan = SyncEngine(LOCAL_MUSIC, device_folder(profile, root), **profile_options(profile)).plan()
+                orphans = [step["path"] for step in plan if step["action"] == "delete"]
+                if orphans:
+                    sections.append(f"The next sync would delete {len(orphans)} files from {name}:\n\n{preview_list(orphans)}")
+                else:
+                    sections.append(f"{name} has no files that are missing from your library.")
+            self.ui(lambda: show_custom_message(self.root, "Mirror Cleanup Preview", "\n\n".join(sections)))
+        threading.Thread(target=worker, daemon=True).start()
+
+    # {profile name: mount root} of the configured devices that are attached
+    def check_device(self) -> tuple:
+        volumes = None
+        present = []
+        for profile in PROFILES:
+            if profile["drive"] is not None:
+                try:
+                    drive_exists = profile["drive"].exists()
+                except OSError:
+                    drive_exists = False
+                if drive_exists and get_volume_label(profile["drive"]) == profile["label"]:
+                    present.append((profile["name"], profile["drive"]))
+            else:
+                if volumes is None: volumes = mounted_volumes()
+                if profile["label"] in volumes:
+                    present.append((profile["name"], volumes[profile["label"]]))
+        return tuple(present)
+
+    # called by the watcher thread only when a device appears or goes away
+    def on_device_change(self, present):
+        present = dict(present)
+        arrived = [name for name in present if name not in self.present]
+        self.synced &= set(present)
+        self.present = present
+        self.tray_icon.icon = self.icons[bool(present)]
+        for name in arrived:
+            if name not in self.synced:
+                self.ui(lambda name=name: self.ask_to_sync(name))
 
     def edit_settings(self, icon=None, item=None):
-        set_modern_style()
         config = load_config() or {}
         setup_win = tk.Toplevel(self.root)
         setup_win.title("Edit Settings")
@@ -374,11 +519,10 @@ class SyncApp:
             config["EXPECTED_VOLUME_NAME"] = volume_var.get()
             save_config(config)
             # Update global variables to apply changes immediately
-            global USB_DRIVE, USB_MUSIC, LOCAL_MUSIC, EXPECTED_VOLUME_NAME
-            USB_DRIVE = Path(config["USB_DRIVE"] + "/")
-            USB_MUSIC = Path(config["REMOTE_FOLDER"])
+            global LOCAL_MUSIC, PROFILES
             LOCAL_MUSIC = Path(config["LOCAL_FOLDER"])
-            EXPECTED_VOLUME_NAME = config["EXPECTED_VOLUME_NAME"]
+            PROFILES = load_profiles(config)
+            self.watcher.refresh()
             show_custom_message(setup_win, "Saved", "Settings updated successfully.")
             setup_win.destroy()
 
@@ -392,10 +536,12 @@ class SyncApp:
         setup_win.minsize(min_width, min_height)
         center_window(setup_win, width, height)
 
-    def ask_to_sync(self):
-        if self.shutdown_requested:
+    def ask_to_sync(self, name):
+        if self.shutdown_requested or name not in self.present or name in self.sessions or name in self.prompting:
             return
-        self.sync_running = True
+        self.prompting.add(name)
+        from syncEngine import has_pending_journal
+        remote = device_folder(profile_named(name), self.present[name])
 
         popup = tk.Toplevel(self.root)
         popup.title("USB Detected")
@@ -408,7 +554,8 @@ class SyncApp:
 
         frm = ttk.Frame(popup, padding=20, style="Card.TFrame")
         frm.pack(fill="both", expand=True)
-        ttk.Label(frm, text="Music USB detected.\nWould you like to sync now?", style="Header.TLabel").pack(pady=18)
+        prompt = "Would you like to resume the\ninterrupted sync?" if has_pending_journal(remote) else "Would you like to sync now?"
+        ttk.Label(frm, text=f"{name} detected.\n{prompt}", style="Header.TLabel").pack(pady=18)
         response = tk.BooleanVar()
         btn_frame = ttk.Frame(frm, style="Card.TFrame")
         btn_frame.pack(pady=10)
@@ -418,24 +565,89 @@ class SyncApp:
         ttk.Button(btn_frame,text="No", command=no, style="Secondary.TButton").pack(side="right", padx=18, ipadx=10, ipady=2)
 
         popup.update(); popup.focus_force(); popup.wait_window()
-        if response.get(): self.start_sync()
-        else: self.sync_running=False
-
-    def start_sync(self):
+        self.prompting.discard(name)
+        if response.get(): self.start_sync(name)
+
+    def start_sync(self, name):
+        if self.shutdown_requested or name not in self.present or name in self.sessions: return
+        from syncEngine import SharedLibrary
+        profile = profile_named(name)
+        # syncs that overlap share one scan of the library; the first one to start a batch rescans.
+        # Verify sessions don't count, they never read the library.
+        if not any(not session.verify for session in self.sessions.values()):
+            if self.library: self.library.close()
+            self.library = SharedLibrary(LOCAL_MUSIC, full_rescan_hours=profile_options(profile)["full_rescan_hours"])
+        self.sessions[name] = SyncWindow(self, profile, self.present[name], len(self.sessions))
+
+    def finish_sync(self, session, counts):
+        self.sessions.pop(session.name, None)
         if self.shutdown_requested: return
+        session.progress_window.destroy()
+        import winsound
+        winsound.MessageBeep(winsound.MB_ICONASTERISK)
+        if session.verify:
+            show_custom_message(self.root, "Verify Complete", f"Checked files on {session.name}.\n" + verify_summary(counts))
+            return
+        self.synced.add(session.name)
+
+        result = show_custom_message(
+            self.root, "Sync Complete", f"Music sync to {session.name} completed.\n" + sync_summary(counts) + "\n\nWould you like to safely eject the drive now?", "yesno"
+        )
+
+        if result:
+            if eject_drive_windows(session.root_path.drive):
+                show_custom_message(self.root, "Safe to Remove", f"You may now safely remove {session.name}.")
+            else:
+                show_custom_message(self.root, "Eject Failed", "Automatic eject failed. Eject manually.")
+        else:
+            show_custom_message(self.root, "Remember", "Remember to safely eject your USB drive before removing it.")
+
+    def tray_run(self): self.tray_icon.run()
+    def exit_app(self,icon=None,item=None):
+        self.shutdown_requested=True
+        self.watcher.stop()
+        self.ui_calls.put(None)
+        try: self.root.destroy()
+        except: pass
+        self.tray_icon.stop(); sys.exit(0)
+
+# progress window and engine run for one device; each device gets its own window, event
+# queue and copy workers, while the library scan is shared through app.library. With verify
+# ("all" or "incremental") the window runs a device verify instead of a sync.
+class SyncWindow:
+    def __init__(self, app, profile, root_path, index=0, verify=None):
+        self.app = app
+        self.root = app.root
+        self.name = profile["name"]
+        self.profile = profile
+        self.root_path = root_path
+        self.remote = device_folder(profile, root_path)
+        self.verify = verify
+        self.progress_queue = queue.Queue()
+
         self.progress_window = tk.Toplevel(self.root)
-        self.progress_window.title("Syncing Music")
-        w,h = 520,320
+        self.progress_window.title(f"{'Verifying' if verify else 'Syncing Music'} - {self.name}")
+        w,h = 520,380
         center_window(self.progress_window,w,h)
+        if index:
+            # cascade windows of concurrent syncs
+            x, y = self.progress_window.winfo_x() + 30*index, self.progress_window.winfo_y() + 30*index
+            self.progress_window.geometry(f"{w}x{h}+{x}+{y}")
         self.progress_window.resizable(False, False)
         self.progress_window.configure(bg=DARK_BG)
 
         frm = ttk.Frame(self.progress_window, padding=20, style="Card.TFrame")
         frm.pack(fill="both", expand=True)
 
-        ttk.Label(frm,text="Syncing music to USB...", style="Field.TLabel").pack(pady=10)
+        ttk.Label(frm,text=f"Verifying files on {self.name}..." if verify else f"Syncing music to {self.name}...", style="Field.TLabel").pack(pady=10)
         self.progress_bar = ttk.Progressbar(frm, orient="horizontal", length=460, mode="determinate", style="Accent.Horizontal.TProgressbar")
         self.progress_bar.pack(pady=10)
+        self.bytes_done, self.bytes_total, self.bytes_started = 0, None, time.monotonic()
+        self.files_done, self.files_total = 0, None
+        self.bytes_label = ttk.Label(frm, text="", style="Path.TLabel")
+        self.bytes_label.pack()
+        self.current_label = ttk.Label(frm, text="", style="Field.TLabel")
+        self.current_label.pack()
 
         self.verbose_text = scrolledtext.ScrolledText(frm,width=65,height=10,state='disabled', bg="#181a1b", fg=DARK_FG, font=("Consolas", 9), insertbackground=DARK_FG)
         self.verbose_text.pack(pady=5)
@@ -444,97 +656,108 @@ class SyncApp:
         self.root.after(100,self.update_progress_ui)
 
     def sync_worker(self):
-        if self.shutdown_requested: return
-        USB_MUSIC.mkdir(parents=True, exist_ok=True)
-        local_files = collect_local_files(LOCAL_MUSIC)
-        usb_files = {f.relative_to(USB_MUSIC) for f in USB_MUSIC.rglob("*") if f.is_file()}
-        total,copied,skipped = len(local_files),0,0
-        self.progress_queue.put(("init",total))
-        for idx, src in enumerate(local_files,start=1):
-            if self.shutdown_requested: break
-            rel = src.relative_to(LOCAL_MUSIC)
-            dest = USB_MUSIC/rel
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            if rel in usb_files:
-                skipped+=1
-                msg = f"Skipped: {rel} ({idx}/{total} - {int(idx/total*100)}%)"
-            else:
-                shutil.copy2(src,dest)
-                copied+=1
-                msg = f"Copied: {rel} ({idx}/{total} - {int(idx/total*100)}%)"
-            self.progress_queue.put(("progress", idx, copied, skipped, msg))
-        self.progress_queue.put(("done", copied, skipped))
+        from syncEngine import SyncEngine, ProgressCoalescer, LOG_FILE
+        if self.app.shutdown_requested: return
+        # one device keeps the plain log name, others get their own
+        log_path = LOG_FILE.replace("sync", "verify") if self.verify else LOG_FILE
+        if len(PROFILES) > 1: log_path = log_path.replace(".txt", f"_{self.name}.txt")
+        progress = ProgressCoalescer(self.progress_queue.put, log_path=log_path)
+        engine = SyncEngine(LOCAL_MUSIC, self.remote, **profile_options(self.profile), on_event=progress,
+                            cancelled=lambda: self.app.shutdown_requested, confirm_delete=self.confirm_prune, report=True,
+                            library=self.app.library, name=self.name if len(PROFILES) > 1 else None,
+                            on_io_profile=lambda io_profile: save_io_profile(self.profile["label"], io_profile))
+        if self.verify: engine.verify(incremental=self.verify == "incremental")
+        else: engine.run()
+
+    # asked by the engine before a cleanup larger than the delete cap; waits for the UI thread's answer
+    def confirm_prune(self, orphans) -> bool:
+        answer = {}
+        answered = threading.Event()
+        def ask():
+            answer["ok"] = show_custom_message(
+                self.progress_window, "Confirm Cleanup",
+                f"Mirror mode would delete {len(orphans)} files from {self.name}\nthat are no longer in your library:\n\n{preview_list(orphans)}\n\nDelete them?",
+                "yesno")
+            answered.set()
+        self.root.after(0, ask)
+        while not answered.wait(0.2):
+            if self.app.shutdown_requested: return False
+        return bool(answer.get("ok"))
 
     def update_progress_ui(self):
-        if self.shutdown_requested: self.root.quit(); return
+        from syncEngine import format_bytes
+        if self.app.shutdown_requested: self.root.quit(); return
         try:
             while True:
                 msg = self.progress_queue.get_nowait()
-                if msg[0]=="init": self.progress_bar["maximum"]=msg[1]
-                elif msg[0]=="progress":
-                    _,cur,copied,skipped,text = msg
-                    self.progress_bar["value"]=cur
-                    self.verbose_text.config(state='normal')
-                    self.verbose_text.insert(tk.END,text+"\n")
-                    self.verbose_text.see(tk.END)
-                    self.verbose_text.config(state='disabled')
+                if msg[0]=="init":
+                    if msg[1] is None:
+                        self.progress_bar.config(mode="indeterminate")
+                        self.progress_bar.start(15)
+                    else:
+                        self.progress_bar["maximum"]=msg[1]
+                        self.files_total = msg[1]
+                elif msg[0]=="total":
+                    self.progress_bar.stop()
+                    self.progress_bar.config(mode="determinate", maximum=max(msg[1],1))
+                    self.files_total, self.bytes_total = msg[1], msg[2]
+                elif msg[0]=="update":
+                    _,cur,copied,skipped,nbytes,current,lines = msg
+                    if cur is not None:
+                        self.files_done = cur
+                        if str(self.progress_bar["mode"])=="determinate": self.progress_bar["value"]=cur
+                    self.bytes_done += nbytes
+                    self.current_label.config(text=current if len(current) <= 70 else "..." + current[-67:])
+                    if lines: self.append_log(lines)
                 elif msg[0]=="done":
-                    _,copied,skipped = msg
-                    self.finish_sync(copied,skipped)
+                    self.app.finish_sync(self, msg[1])
                     return
         except queue.Empty: pass
+        files = f"{self.files_done} of {self.files_total} files" if self.files_total else f"{self.files_done} files"
+        if self.bytes_done:
+            rate = self.bytes_done / max(time.monotonic() - self.bytes_started, 1e-3)
+            of = f" of {format_bytes(self.bytes_total)}" if self.bytes_total else ""
+            files += f" - {format_bytes(self.bytes_done)}{of} ({format_bytes(rate)}/s)"
+        self.bytes_label.config(text=files)
         self.root.after(100,self.update_progress_ui)
 
-    def finish_sync(self, copied, skipped):
-        if self.shutdown_requested: return
-        self.progress_window.destroy()
-        winsound.MessageBeep(winsound.MB_ICONASTERISK)
-        self.synced_this_session=True
-        self.sync_running=False
-
-        result = show_custom_message(
-            self.root, "Sync Complete", f"Music sync completed.\nCopied: {copied}\nSkipped: {skipped}\n\nWould you like to safely eject the drive now?", "yesno"
-        )
-
-        if result:
-            if eject_drive_windows(USB_DRIVE.drive):
-                show_custom_message(self.root, "Safe to Remove", "You may now safely remove the USB drive.")
-            else:
-                show_custom_message(self.root, "Eject Failed", "Automatic eject failed. Eject manually.")
-        else:
-            show_custom_message(self.root, "Remember", "Remember to safely eject your USB drive before removing it.")
-
-    def tray_run(self): self.tray_icon.run()
-    def exit_app(self,icon=None,item=None):
-        self.shutdown_requested=True
-        try: self.root.destroy()
-        except: pass
-        self.tray_icon.stop(); sys.exit(0)
-
-def main():
-    root = tk.Tk()
-    root.withdraw()
-    set_modern_style()
+    # the log view is a ring buffer of the last LOG_VIEW_LINES lines; the full log is in LOG_FILE
+    def append_log(self, lines):
+        from syncEngine import LOG_VIEW_LINES
+        self.verbose_text.config(state='normal')
+        self.verbose_text.insert(tk.END, "\n".join(lines)+"\n")
+        excess = int(self.verbose_text.index("end-1c").split(".")[0]) - 1 - LOG_VIEW_LINES
+        if excess > 0: self.verbose_text.delete("1.0", f"{excess+1}.0")
+        self.verbose_text.see(tk.END)
+        self.verbose_text.config(state='disabled')
+
+# loads the config and brings up the tray and the device watcher; Tk is only loaded here
+# when the first-launch setup or an error has to be shown
+def start() -> SyncApp:
+    root = None
     config = load_config()
-    if config is None: config = first_launch_setup(root)
+    if config is None:
+        root = load_ui()
+        config = first_launch_setup(root)
 
-    global USB_DRIVE, USB_MUSIC, LOCAL_MUSIC, EXPECTED_VOLUME_NAME
-    USB_DRIVE = Path(config["USB_DRIVE"]+"/")
-    USB_MUSIC = Path(config["REMOTE_FOLDER"])
+    global LOCAL_MUSIC, PROFILES, DEVICE_WATCHER
     LOCAL_MUSIC = Path(config["LOCAL_FOLDER"])
-    EXPECTED_VOLUME_NAME = config["EXPECTED_VOLUME_NAME"]
+    PROFILES = load_profiles(config)
+    DEVICE_WATCHER = config.get("DEVICE_WATCHER", "auto")
 
     if not LOCAL_MUSIC.exists():
-        show_custom_message(root, "Error", f"Local folder not found:\n{LOCAL_MUSIC}")
+        show_custom_message(root or load_ui(), "Error", f"Local folder not found:\n{LOCAL_MUSIC}")
         sys.exit(1)
 
-    app = SyncApp(root)
-    threading.Thread(target=app.tray_icon.run, daemon=True).start()
+    return SyncApp(root)
+
+def main():
+    app = start()
     try:
-        root.mainloop()
+        app.run_ui()
     except KeyboardInterrupt:
         app.shutdown_requested=True
-        try: root.destroy()
+        try: app.root.destroy()
         except: pass
         app.tray_icon.stop()
         sys.exit(130)
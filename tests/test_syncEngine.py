@@ -0,0 +1,262 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import syncEngine
+from syncEngine import (SyncEngine, copy_file, hash_file, partial_path, has_pending_journal,
+                        load_device_manifest)
+
+def write(path: Path, data: bytes, mtime=None) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+def device_tree(dest: Path) -> dict[str, bytes]:
+    return {p.relative_to(dest).as_posix(): p.read_bytes() for p in dest.rglob("*")
+            if p.is_file() and not p.name.startswith(".musync")}
+
+@pytest.fixture
+def library(tmp_path) -> Path:
+    src = tmp_path / "library"
+    write(src / "Artist/Album/01.mp3", b"one" * 1000, 1_600_000_000)
+    write(src / "Artist/Album/02.mp3", b"two" * 2000, 1_600_000_000)
+    write(src / "Other/03.flac", b"three" * 3000, 1_600_000_000)
+    return src
+
+@pytest.fixture
+def sync(tmp_path, library):
+    dest = tmp_path / "device"
+    def run(**options) -> SyncEngine:
+        options.setdefault("full_rescan_hours", 0)
+        engine = SyncEngine(library, dest, state_dir=str(tmp_path), **options)
+        engine.run()
+        return engine
+    run.dest = dest
+    return run
+
+def test_plan_leaves_device_untouched(tmp_path, library):
+    dest = tmp_path / "device"
+    plan = SyncEngine(library, dest, state_dir=str(tmp_path)).plan()
+    assert sorted((step["action"], step["path"]) for step in plan) == [
+        ("copy", "Artist/Album/01.mp3"), ("copy", "Artist/Album/02.mp3"), ("copy", "Other/03.flac")]
+    assert not dest.exists()
+
+def test_copy_then_skip(sync, library):
+    engine = sync()
+    assert engine.counts["copy"] == 3 and engine.error is None
+    assert device_tree(sync.dest) == device_tree(library)
+    assert os.stat(sync.dest / "Other/03.flac").st_mtime == 1_600_000_000
+    assert set(load_device_manifest(sync.dest)) == set(device_tree(library))
+    engine = sync()
+    assert engine.counts["skip"] == 3 and engine.counts["copy"] == engine.counts["update"] == 0
+
+def test_update_changed_file(sync, library):
+    sync()
+    write(library / "Artist/Album/01.mp3", b"retagged" * 500, 1_700_000_000)
+    engine = sync()
+    assert engine.counts["update"] == 1
+    assert (sync.dest / "Artist/Album/01.mp3").read_bytes() == b"retagged" * 500
+
+def test_moved_file_is_renamed_on_device(sync, library):
+    sync()
+    os.renames(library / "Other/03.flac", library / "Moved/03.flac")
+    engine = sync(detect_moves=True)
+    assert engine.counts["move"] == 1 and engine.counts["copy"] == 0
+    assert not (sync.dest / "Other").exists()
+    assert (sync.dest / "Moved/03.flac").read_bytes() == b"three" * 3000
+
+def test_mirror_prunes_only_when_enabled(sync, library):
+    sync()
+    os.remove(library / "Artist/Album/02.mp3")
+    sync(detect_moves=False)
+    assert (sync.dest / "Artist/Album/02.mp3").exists()
+    engine = sync(mirror=True)
+    assert engine.counts["delete"] == 1
+    assert not (sync.dest / "Artist/Album/02.mp3").exists()
+    assert (sync.dest / "Artist/Album/01.mp3").exists()
+
+def test_mirror_over_cap_needs_confirmation(sync, library):
+    sync()
+    for rel in ("Artist/Album/01.mp3", "Artist/Album/02.mp3"):
+        os.remove(library / rel)
+    engine = sync(mirror=True, delete_cap=1, confirm_delete=lambda orphans: False)
+    assert engine.counts["delete"] == 0
+    assert len(device_tree(sync.dest)) == 3
+
+def test_mirror_skipped_when_library_unreadable(sync, library, monkeypatch):
+    sync()
+    scandir = os.scandir
+    def failing(path):
+        if str(path) == os.path.join(str(library), "Artist"):
+            raise PermissionError(13, "Permission denied", str(path))
+        return scandir(path)
+    monkeypatch.setattr(syncEngine.os, "scandir", failing)
+    engine = sync(mirror=True)
+    monkeypatch.undo()
+    assert engine.counts["delete"] == 0
+    assert len(device_tree(sync.dest)) == 3
+
+def test_copy_file_resumes_partial(tmp_path):
+    chunk = 64 * 1024
+    src = write(tmp_path / "big.mp3", os.urandom(5 * chunk + 123), 1_600_000_000)
+    dest = tmp_path / "device/big.mp3"
+    dest.parent.mkdir()
+    size, mtime = src.stat().st_size, src.stat().st_mtime
+    written = []
+    assert copy_file(src, dest, size, mtime, written.append, lambda: len(written) >= 3, chunk) is None
+    assert not dest.exists() and partial_path(dest, size, mtime).exists()
+    resumed = []
+    digest = copy_file(src, dest, size, mtime, resumed.append, None, chunk)
+    assert sum(resumed) < size
+    assert digest == hash_file(src)
+    assert dest.read_bytes() == src.read_bytes()
+    assert not partial_path(dest, size, mtime).exists()
+
+def test_interrupted_sync_resumes_from_journal(sync, library):
+    copied = []
+    def cancel():
+        return len(copied) >= 1
+    engine = SyncEngine(library, sync.dest, state_dir=str(sync.dest.parent), copy_workers=1, cancelled=cancel,
+                        on_event=lambda event: event[0] == "progress" and copied.append(event))
+    engine.run()
+    assert has_pending_journal(sync.dest)
+    engine = sync()
+    assert not has_pending_journal(sync.dest)
+    assert device_tree(sync.dest) == device_tree(library)
+
+def test_verify_reports_without_deleting(sync, library):
+    sync()
+    damaged = sync.dest / "Artist/Album/01.mp3"
+    st = damaged.stat()
+    write(damaged, b"X" * st.st_size, st.st_mtime)
+    os.remove(sync.dest / "Other/03.flac")
+    counts = SyncEngine(library, sync.dest, state_dir=str(sync.dest.parent)).verify()
+    assert counts == {"verified": 1, "mismatch": 1, "missing": 1, "failed": 0, "unchecked": 0}
+    assert damaged.exists()
+    engine = sync()
+    assert engine.counts["copy"] + engine.counts["update"] == 2
+    assert device_tree(sync.dest) == device_tree(library)
+    counts = SyncEngine(library, sync.dest, state_dir=str(sync.dest.parent)).verify()
+    assert counts["verified"] == 3
+
+def test_unexpected_error_still_reports_done(tmp_path, library, monkeypatch):
+    events = []
+    def broken(*args, **kwargs):
+        raise TypeError("malformed manifest entry")
+    monkeypatch.setattr(syncEngine, "plan_file", broken)
+    engine = SyncEngine(library, tmp_path / "device", state_dir=str(tmp_path), on_event=events.append)
+    engine.run()
+    assert engine.error == "TypeError: malformed manifest entry"
+    assert events[-1][0] == "done"
+
+@pytest.mark.parametrize("priority", ["smallest", "library"])
+def test_first_sync_fills_device_like_plan(tmp_path, monkeypatch, priority):
+    src = tmp_path / "library"
+    for i in range(10):
+        write(src / f"A/big{i}.mp3", b"B" * 2**20)
+        write(src / f"Z/small{i}.mp3", b"s" * 100 * 1024)
+    dest = tmp_path / "device"
+    dest.mkdir()
+    monkeypatch.setattr(syncEngine, "disk_free", lambda path: int(2.5 * 2**20))
+    options = dict(state_dir=str(tmp_path), priority=priority, space_reserve_mb=0, detect_moves=False)
+    planned = {step["path"] for step in SyncEngine(src, dest, **options).plan() if step["action"] == "copy"}
+    engine = SyncEngine(src, dest, **options)
+    engine.run()
+    assert set(device_tree(dest)) == planned
+    assert engine.counts["copy"] == len(planned) and engine.counts["nospace"] == 20 - len(planned)
+    if priority == "smallest":
+        assert {f"Z/small{i}.mp3" for i in range(10)} <= planned
+
+def test_transcode_never_overwrites_a_library_file(tmp_path, monkeypatch):
+    import transcoder
+    def fake_ffmpeg(args, **kwargs):
+        Path(args[-1]).write_bytes(b"E" * 500)
+        return transcoder.subprocess.CompletedProcess(args, 0, "", "")
+    monkeypatch.setattr(transcoder.subprocess, "run", fake_ffmpeg)
+    src = tmp_path / "library"
+    write(src / "a/song.flac", b"F" * 2000)
+    write(src / "a/song.mp3", b"M" * 100)
+    write(src / "a/other.flac", b"O" * 2000)
+    dest = tmp_path / "device"
+    logs = []
+    options = dict(state_dir=str(tmp_path), full_rescan_hours=0, on_event=lambda e: e[0] == "log" and logs.append(e[1]),
+                   transcode={"formats": ["flac"], "codec": "mp3", "bitrate": "192k", "cache_mb": 10,
+                              "workers": 1, "ffmpeg": sys.executable})
+    for _ in range(3):
+        engine = SyncEngine(src, dest, **options)
+        engine.run()
+        assert device_tree(dest) == {"a/song.mp3": b"M" * 100, "a/other.mp3": b"E" * 500}
+    assert engine.counts["skip"] == 2 and engine.counts["copy"] == engine.counts["update"] == 0
+    assert any("a/song.flac" in line and "Not transcoded" in line for line in logs)
+
+def test_scan_failure_fails_the_sync(sync, library, monkeypatch):
+    sync()
+    def broken(self):
+        yield "Artist/Album/01.mp3", 3000, 1_600_000_000
+        raise RuntimeError("scanner crashed")
+    monkeypatch.setattr(syncEngine.LibrarySnapshot, "scan", broken)
+    engine = sync(mirror=True)
+    assert engine.error == "RuntimeError: scanner crashed"
+    assert engine.counts["delete"] == 0
+    assert len(device_tree(sync.dest)) == 3
+
+def test_unreadable_entry_skips_mirror(sync, library, monkeypatch):
+    sync()
+    scandir = os.scandir
+    class Entry:
+        def __init__(self, entry): self.entry, self.name = entry, entry.name
+        def is_dir(self, **kwargs):
+            if self.name == "02.mp3": raise PermissionError(13, "Permission denied")
+            return self.entry.is_dir(**kwargs)
+        def is_file(self): return self.entry.is_file()
+        def stat(self): return self.entry.stat()
+    monkeypatch.setattr(syncEngine.os, "scandir", lambda path: [Entry(e) for e in scandir(path)])
+    engine = sync(mirror=True)
+    monkeypatch.undo()
+    assert engine.error is None and engine.counts["delete"] == 0
+    assert len(device_tree(sync.dest)) == 3
+
+def test_mirror_sweeps_partials_only_after_an_interruption(sync, library, monkeypatch):
+    write(library / "Mix/long.mp3", os.urandom(3 * 2**20))
+    sync()
+    def no_walk(*args):
+        raise AssertionError("device walked without an interrupted copy")
+    with monkeypatch.context() as m:
+        m.setattr(syncEngine.os, "walk", no_walk)
+        sync(mirror=True)
+    write(library / "Mix/long.mp3", os.urandom(3 * 2**20 + 1), 1_700_000_000)
+    copied = []
+    engine = SyncEngine(library, sync.dest, state_dir=str(sync.dest.parent), full_rescan_hours=0,
+                        cancelled=lambda: len(copied) >= 2, on_event=lambda e: e[0] == "bytes" and copied.append(e))
+    engine.chunk_size = 2**20
+    engine.run()
+    assert list(sync.dest.glob("Mix/.musync-long.mp3.*.part"))
+    os.remove(library / "Mix/long.mp3")
+    sync()
+    sync(mirror=True)
+    assert not list(sync.dest.rglob("*.part"))
+    assert not (sync.dest / syncEngine.PARTIALS_MARKER).exists()
+
+def test_retag_in_place_is_synced_from_cached_listing(sync, library):
+    sync(full_rescan_hours=24)
+    retagged = library / "Artist/Album/01.mp3"
+    folder = retagged.parent.stat().st_mtime
+    with open(retagged, "r+b") as f:
+        f.seek(0, 2)
+        f.write(b"TAG" * 100)
+    os.utime(retagged.parent, (folder, folder))
+    engine = sync(full_rescan_hours=24)
+    assert engine.counts["update"] == 1 and engine.counts["skip"] == 2
+    assert (sync.dest / "Artist/Album/01.mp3").read_bytes() == retagged.read_bytes()
+
+def test_json_keeps_progress_on_stderr(tmp_path, library, capsys):
+    import json
+    assert syncEngine.main([str(library), str(tmp_path / "device"), "--state-dir", str(tmp_path), "--json"]) == 0
+    out, err = capsys.readouterr()
+    assert json.loads(out)["dry_run"] is False
+    assert "Other/03.flac" in err
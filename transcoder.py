@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+TRANSCODE_DIR = "transcode_cache"
+TRANSCODE_INDEX = "index.json"
+DEFAULT_CACHE_MB = 4096
+# codec name -> (ffmpeg encoder, ffmpeg muxer, file extension)
+CODECS = {
+    "aac": ("aac", "ipod", ".m4a"),
+    "mp3": ("libmp3lame", "mp3", ".mp3"),
+    "opus": ("libopus", "opus", ".opus"),
+}
+
+# On-disk cache of encoded files keyed by the source content hash and the encoder settings,
+# so later syncs and other devices with the same settings reuse an encode. Entries are
+# evicted least recently used first once the cache grows past max_bytes. Encodes run as
+# ffmpeg processes, at most `workers` at a time.
+class TranscodeCache:
+    def __init__(self, folder, max_bytes=DEFAULT_CACHE_MB * 2**20, workers=None, ffmpeg="ffmpeg"):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        # {key: [size, last used, codec]}
+        self.index = {}
+        self.dirty = False
+        try:
+            with open(self.folder / TRANSCODE_INDEX, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def available(self) -> bool:
+        return self.ffmpeg is not None
+
+    def path(self, key, codec) -> Path:
+        return self.folder / key[:2] / (key + CODECS[codec][2])
+
+    # future for the encoded copy of src; concurrent requests for the same source share one encode
+    def fetch(self, src: Path, size, mtime, codec, bitrate, digest):
+        ident = (str(src), size, mtime, codec, bitrate)
+        with self.lock:
+            future = self.inflight.get(ident)
+            if future is None:
+                future = self.inflight[ident] = self.pool.submit(self.encode, ident, src, mtime, codec, bitrate, digest)
+        return future
+
+    def encode(self, ident, src: Path, mtime, codec, bitrate, digest) -> Path:
+        try:
+            key = hashlib.blake2b(f"{digest()}|{codec}|{bitrate}".encode(), digest_size=16).hexdigest()
+            path = self.path(key, codec)
+            with self.lock:
+                if key in self.index and path.exists():
+                    self.index[key][1] = time.time()
+                    self.dirty = True
+                    return path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            encoder, muxer, _ext = CODECS[codec]
+            result = subprocess.run(
+                [self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", str(src), "-vn", "-map_metadata", "0",
+                 "-c:a", encoder, "-b:a", bitrate, "-f", muxer, str(tmp)],
+                capture_output=True, text=True, errors="replace",
+                creationflags=getattr(subprocess, "BELOW_NORMAL_PRIORITY_CLASS", 0))
+            if result.returncode != 0:
+                try: os.remove(tmp)
+                except OSError: pass
+                raise OSError(f"ffmpeg failed: {(result.stderr.strip().splitlines() or ['exit %d' % result.returncode])[-1]}")
+            # the encode carries the source mtime so the device copy does too
+            os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, path)
+            with self.lock:
+                self.index[key] = [path.stat().st_size, time.time(), codec]
+                self.dirty = True
+                self.evict(keep=key)
+            return path
+        finally:
+            with self.lock:
+                self.inflight.pop(ident, None)
+
+    # drops least recently used encodes until the cache fits; called with the lock held
+    def evict(self, keep=None):
+        total = sum(entry[0] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k][1]):
+            if total <= self.max_bytes: break
+            if key == keep: continue
+            try:
+                os.remove(self.path(key, self.index[key][2]))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue  # still open for another device's copy; retried next time
+            total -= self.index.pop(key)[0]
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            tmp = self.folder / (TRANSCODE_INDEX + ".tmp")
+            try:
+                self.folder.mkdir(parents=True, exist_ok=True)
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(self.index, f, separators=(",", ":"))
+                os.replace(tmp, self.folder / TRANSCODE_INDEX)
+            except OSError:
+                self.dirty = True
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.save()
+
+# one device's transcode settings on top of a shared cache: which source extensions are
+# converted, and to what
+class Transcoder:
+    def __init__(self, cache: TranscodeCache, hashes, local_dir: Path, formats, codec="aac", bitrate="256k"):
+        self.cache = cache
+        self.hashes = hashes
+        self.local_dir = local_dir
+        self.formats = {"." + ext.lower().lstrip(".") for ext in formats}
+        self.codec = codec
+        self.bitrate = bitrate
+        # recorded in the device manifest so a settings change re-encodes the device copies
+        self.tag = f"{codec}-{bitrate}"
+
+    def applies(self, rel) -> bool:
+        return os.path.splitext(rel)[1].lower() in self.formats
+
+    def target(self, rel) -> str:
+        return os.path.splitext(rel)[0] + CODECS[self.codec][2] if self.applies(rel) else rel
+
+    # the library file that already claims rel's device name, if any: a file of that name wins,
+    # and of two sources of the same encode the one first by name. exists(other) tells whether
+    # other is a library file being synced.
+    def shadowed_by(self, rel, exists) -> str | None:
+        target = self.target(rel)
+        if target == rel:
+            return None
+        if exists(target):
+            return target
+        stem = os.path.splitext(rel)[0]
+        for ext in sorted(self.formats):
+            other = stem + ext
+            if other < rel and other.lower() != rel.lower() and exists(other):
+                return other
+        return None
+
+    def fetch(self, rel, size, mtime):
+        return self.cache.fetch(self.local_dir / rel, size, mtime, self.codec, self.bitrate,
+                                lambda: self.hashes.get(self.local_dir, rel, size, mtime))